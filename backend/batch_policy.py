@@ -0,0 +1,102 @@
+import json
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from backend.db import get_conn, transaction
+from config import settings
+
+
+# Поля политики закрытия окна; NULL/отсутствие в chat_policies — дефолт из settings.
+# Непозитивные значения (строки, записанные до валидации) тоже считаются дефолтом.
+POLICY_FIELDS = ("max_messages", "max_chars", "idle_seconds", "max_window_seconds")
+
+
+def default_policy() -> Dict[str, Optional[int]]:
+    return {
+        "max_messages": settings.batch_max_messages,
+        "max_chars": settings.batch_max_chars,
+        "idle_seconds": settings.batch_idle_seconds,
+        "max_window_seconds": settings.batch_window_seconds,
+    }
+
+
+def _merge(row: Optional[Any]) -> Dict[str, Optional[int]]:
+    policy = default_policy()
+    if row is not None:
+        for f in POLICY_FIELDS:
+            if row[f] is not None and row[f] > 0:
+                policy[f] = row[f]
+    return policy
+
+
+# -------------------------
+# Read / write
+# -------------------------
+def get_chat_policy(chat_id: str) -> Dict[str, Optional[int]]:
+    row = get_conn().execute("SELECT * FROM chat_policies WHERE chat_id = ?", (chat_id,)).fetchone()
+    return _merge(row)
+
+
+def get_chat_policies(chat_ids: Iterable[str]) -> Dict[str, Dict[str, Optional[int]]]:
+    """Политики для пачки чатов одним запросом."""
+    chat_ids = list(chat_ids)
+    rows = {
+        r["chat_id"]: r for r in get_conn().execute(
+            "SELECT * FROM chat_policies WHERE chat_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(chat_ids),)
+        )
+    }
+    return {c: _merge(rows.get(c)) for c in chat_ids}
+
+
+def set_chat_policy(chat_id: str, **fields: Optional[int]) -> Dict[str, Optional[int]]:
+    """
+    Задаёт политику чата. Переданные поля перезаписываются (None — вернуть дефолт),
+    не переданные остаются как были. Значения должны быть больше нуля.
+    """
+    unknown = set(fields) - set(POLICY_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown policy fields: {sorted(unknown)}")
+    bad = sorted(f for f, v in fields.items() if v is not None and v <= 0)
+    if bad:
+        raise ValueError(f"policy fields must be positive: {bad}")
+
+    with transaction() as conn:
+        row = conn.execute("SELECT * FROM chat_policies WHERE chat_id = ?", (chat_id,)).fetchone()
+        values = {f: (row[f] if row is not None else None) for f in POLICY_FIELDS}
+        values.update(fields)
+        conn.execute("""
+          INSERT OR REPLACE INTO chat_policies (chat_id, max_messages, max_chars, idle_seconds, max_window_seconds, updated_at)
+          VALUES (?, ?, ?, ?, ?, ?)
+        """, (chat_id, values["max_messages"], values["max_chars"], values["idle_seconds"],
+              values["max_window_seconds"], int(time.time())))
+    return get_chat_policy(chat_id)
+
+
+# -------------------------
+# Когда закрывать окно
+# -------------------------
+def over_budget(batch: Dict[str, Any], policy: Dict[str, Optional[int]]) -> bool:
+    max_messages = policy["max_messages"]
+    max_chars = policy["max_chars"]
+    if max_messages and batch["message_count"] >= max_messages:
+        return True
+    if max_chars and batch["char_count"] >= max_chars:
+        return True
+    return False
+
+
+def batch_deadline(batch: Dict[str, Any], policy: Dict[str, Optional[int]]) -> int:
+    """
+    Момент закрытия окна (unix ts): сразу, если превышен бюджет сообщений/символов,
+    иначе раньшее из «пауза idle_seconds после последнего сообщения»
+    и «жёсткий предел max_window_seconds от первого».
+    """
+    if over_budget(batch, policy):
+        return batch["started_at"]
+
+    deadline = batch["started_at"] + (policy["max_window_seconds"] or settings.batch_window_seconds)
+    if policy["idle_seconds"]:
+        last = batch.get("last_message_at") or batch["started_at"]
+        deadline = min(deadline, last + policy["idle_seconds"])
+    return deadline
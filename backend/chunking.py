@@ -0,0 +1,101 @@
+import re
+from typing import Any, Dict, List
+
+from backend.llm_client import estimate_tokens
+
+
+# -------------------------
+# Map: режем батч на чанки по границам сообщений
+# -------------------------
+def split_into_chunks(lines: List[str], max_tokens: int) -> List[List[str]]:
+    """
+    Раскладывает строки батча («user: text») по чанкам не больше max_tokens
+    (оценка через estimate_tokens). Сообщение не разрывается между чанками;
+    только одиночное сообщение, которое само больше бюджета, режется по символам.
+    """
+    chunks: List[List[str]] = []
+    current: List[str] = []
+    current_tokens = 0
+
+    for line in lines:
+        tokens = estimate_tokens(line) + 1
+        if tokens > max_tokens:
+            if current:
+                chunks.append(current)
+                current, current_tokens = [], 0
+            step = max(1, len(line) * max_tokens // tokens)
+            for i in range(0, len(line), step):
+                chunks.append([line[i:i + step]])
+            continue
+
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+
+        current.append(line)
+        current_tokens += tokens
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# -------------------------
+# Reduce: сливаем темы из разных чанков
+# -------------------------
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _title_words(title: str) -> set:
+    return {w for w in _WORD_RE.findall((title or "").lower().replace("ё", "е")) if len(w) > 2}
+
+
+def _similar_titles(a: str, b: str, threshold: float) -> bool:
+    na = " ".join(sorted(_title_words(a)))
+    nb = " ".join(sorted(_title_words(b)))
+    if not na or not nb:
+        return (a or "").strip().lower() == (b or "").strip().lower()
+    if na == nb:
+        return True
+
+    # только совпадение слов: посимвольная похожесть склеивает «Созвон в понедельник» и «Созвон в пятницу»
+    wa, wb = set(na.split()), set(nb.split())
+    return len(wa & wb) / len(wa | wb) >= threshold
+
+
+def merge_topics(topics: List[Dict[str, Any]], threshold: float = 0.8) -> List[Dict[str, Any]]:
+    """
+    Объединяет темы одного типа с одинаковыми/почти одинаковыми по словам заголовками
+    (темы одного обсуждения из соседних чанков). cleaned_text склеивается без повторяющихся строк,
+    заголовок берётся у первой встреченной темы.
+    """
+    merged: List[Dict[str, Any]] = []
+
+    for t in topics:
+        title = (t.get("title") or "").strip()
+        ku_type = t.get("type") or "Discussion"
+        cleaned = (t.get("cleaned_text") or "").strip()
+
+        target = None
+        for m in merged:
+            if m["type"] == ku_type and _similar_titles(m["title"], title, threshold):
+                target = m
+                break
+
+        if target is None:
+            merged.append({
+                "title": title,
+                "type": ku_type,
+                "cleaned_text": cleaned,
+                "_lines": set(cleaned.splitlines()),
+            })
+            continue
+
+        new_lines = [ln for ln in cleaned.splitlines() if ln not in target["_lines"]]
+        if new_lines:
+            target["cleaned_text"] = "\n".join([target["cleaned_text"], *new_lines]).strip()
+            target["_lines"].update(new_lines)
+
+    for m in merged:
+        del m["_lines"]
+    return merged
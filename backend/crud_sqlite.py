@@ -1,12 +1,33 @@
+import asyncio
+import base64
 import json
 import time
 import re
+import copy
+import sqlite3
+import weakref
 from uuid import uuid4
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple, Callable
 
-from backend.db import get_conn
-from backend.llm_client import decide_ku_action, update_ku_content, select_relevant
+from pydantic import ValidationError
+
+from config import settings
+from backend.db import get_conn, transaction, run_db
+from backend.llm_client import (
+    adecide_ku_action, aupdate_ku_content, aselect_relevant, aroute_and_update, get_governor,
+    LLMUnavailableError,
+)
 from backend.models import KUContent
+from backend.noise_filter import filter_noise
+from backend.chunking import split_into_chunks, merge_topics
+from backend.ku_index import get_ku_index, index_ku
+from backend.ku_budget import apply_budget, write_history
+from backend.ku_revisions import write_revision, reconstruct
+from backend.batch_policy import get_chat_policies, batch_deadline
+from backend.jobs import (
+    close_batch, claim_job, renew_lease, complete_job, fail_job, defer_job, load_job_messages,
+    mark_messages_processed,
+)
 
 
 def now_ts() -> int:
@@ -30,22 +51,15 @@ def sanitize_text(s: str) -> str:
 
 # Projects
 def get_or_create_default_project() -> Dict[str, Any]:
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("SELECT * FROM projects WHERE id = ?", ("default",))
-    row = cur.fetchone()
-
+    row = get_conn().execute("SELECT * FROM projects WHERE id = ?", ("default",)).fetchone()
     if row:
-        conn.close()
         return dict(row)
 
-    cur.execute(
-        "INSERT INTO projects (id, name, short_context, project_summary, status) VALUES (?, ?, ?, ?, ?)",
-        ("default", "Default project", "Auto-created", "", "active")
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO projects (id, name, short_context, project_summary, status) VALUES (?, ?, ?, ?, ?)",
+            ("default", "Default project", "Auto-created", "", "active")
+        )
     return {"id": "default", "name": "Default project", "short_context": "Auto-created"}
 
 
@@ -58,60 +72,179 @@ def insert_message(chat_id: str, text: str,
     """
     Returns True if this message started a new batch window for this chat.
     """
-    conn = get_conn()
-    cur = conn.cursor()
+    return insert_messages([{
+        "chat_id": chat_id,
+        "text": text,
+        "user_id": user_id,
+        "user_name": user_name,
+        "message_id": message_id,
+        "sent_at": sent_at,
+    }])[0]
 
-    created_at = now_ts()
-    text = sanitize_text(text or "")
 
-    cur.execute("""
-      INSERT INTO messages (chat_id, user_id, user_name, message_id, sent_at, text, created_at)
-      VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (chat_id, user_id, user_name, message_id, sent_at, text, created_at))
+# подписчики на изменения окон: callback(chat_id, started_at, deadline), вызываются после коммита
+_batch_listeners: List[Callable[[str, int, int], None]] = []
 
-    cur.execute("SELECT started_at FROM open_batches WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
 
-    if row is None:
-        cur.execute("INSERT INTO open_batches (chat_id, started_at) VALUES (?, ?)", (chat_id, created_at))
-        started_new = True
-    else:
-        started_new = False
+def on_batch_updated(callback: Callable[[str, int, int], None]) -> None:
+    if callback not in _batch_listeners:
+        _batch_listeners.append(callback)
 
-    conn.commit()
-    conn.close()
-    return started_new
+
+def remove_batch_listener(callback: Callable[[str, int, int], None]) -> None:
+    if callback in _batch_listeners:
+        _batch_listeners.remove(callback)
+
+
+def insert_messages(items: List[Dict[str, Any]]) -> List[bool]:
+    """
+    Групповая вставка сообщений одной транзакцией (один fsync на пачку).
+    open_batches для всех чатов пачки открываются/обновляются одним запросом:
+    счётчики сообщений и символов и время последнего сообщения нужны
+    для адаптивного закрытия окна (batch_policy).
+    Возвращает флаги started_new_batch в порядке items: True только у первого
+    сообщения чата, для которого окно ещё не было открыто.
+    """
+    if not items:
+        return []
+
+    created_at = now_ts()
+    rows = [
+        (
+            it["chat_id"],
+            it.get("user_id"),
+            it.get("user_name"),
+            it.get("message_id"),
+            it.get("sent_at"),
+            sanitize_text(it.get("text") or ""),
+            created_at,
+        )
+        for it in items
+    ]
+
+    per_chat: Dict[str, List[int]] = {}
+    for r in rows:
+        counters = per_chat.setdefault(r[0], [0, 0])
+        counters[0] += 1
+        counters[1] += len(r[5])
+    chat_ids = list(per_chat)
+
+    with transaction() as conn:
+        conn.executemany("""
+          INSERT INTO messages (chat_id, user_id, user_name, message_id, sent_at, text, created_at)
+          VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+        existing = {
+            r["chat_id"] for r in conn.execute(
+                "SELECT chat_id FROM open_batches WHERE chat_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(chat_ids),)
+            )
+        }
+        new_chats = [c for c in chat_ids if c not in existing]
+
+        conn.executemany("""
+          INSERT INTO open_batches (chat_id, started_at, message_count, char_count, last_message_at)
+          VALUES (?, ?, ?, ?, ?)
+          ON CONFLICT(chat_id) DO UPDATE SET
+            message_count = message_count + excluded.message_count,
+            char_count = char_count + excluded.char_count,
+            last_message_at = excluded.last_message_at
+        """, [(c, created_at, n, chars, created_at) for c, (n, chars) in per_chat.items()])
+
+        batches = [
+            dict(r) for r in conn.execute(
+                "SELECT * FROM open_batches WHERE chat_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(chat_ids),)
+            )
+        ]
+
+    if _batch_listeners:
+        policies = get_chat_policies(chat_ids)
+        for b in batches:
+            deadline = batch_deadline(b, policies[b["chat_id"]])
+            for cb in list(_batch_listeners):
+                try:
+                    cb(b["chat_id"], b["started_at"], deadline)
+                except Exception as e:
+                    print("batch listener error:", e)
+
+    pending = set(new_chats)
+    flags = []
+    for it in items:
+        flags.append(it["chat_id"] in pending)
+        pending.discard(it["chat_id"])
+    return flags
 
 
 # -------------------------
 # KU read/list
 # -------------------------
-def list_kus(project_id: str) -> List[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      SELECT * FROM kus
-      WHERE project_id = ?
-      ORDER BY last_activity_at DESC
-    """, (project_id,))
-    rows = cur.fetchall()
-    conn.close()
+def _encode_cursor(last_activity_at: int, ku_id: str) -> str:
+    raw = json.dumps([last_activity_at, ku_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
-    out = []
-    for r in rows:
+
+def _decode_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        last_activity_at, ku_id = json.loads(raw)
+        return int(last_activity_at), str(ku_id)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+def list_kus(project_id: str, limit: int = 50, cursor: Optional[str] = None,
+             status: Optional[str] = None, ku_type: Optional[str] = None,
+             include_content: bool = False) -> Dict[str, Any]:
+    """
+    Страница KU от самых свежих: keyset по (last_activity_at, id), без OFFSET —
+    любая страница читается по индексу за одинаковое время.
+    По умолчанию — проекция без content_ai_json (summary хранится отдельной колонкой);
+    include_content=True добавляет content_ai (декодируется только для страницы).
+    Возвращает {"items": [...], "next_cursor": str | None}.
+    """
+    limit = max(1, min(int(limit), 200))
+    columns = "id, project_id, type, title, status, summary, created_at, last_activity_at"
+    if include_content:
+        columns += ", content_ai_json"
+
+    where = ["project_id = ?"]
+    params: List[Any] = [project_id]
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if ku_type:
+        where.append("type = ?")
+        params.append(ku_type)
+    if cursor:
+        where.append("(last_activity_at, id) < (?, ?)")
+        params.extend(_decode_cursor(cursor))
+
+    rows = get_conn().execute(f"""
+      SELECT {columns}
+      FROM kus
+      WHERE {" AND ".join(where)}
+      ORDER BY last_activity_at DESC, id DESC
+      LIMIT ?
+    """, (*params, limit + 1)).fetchall()
+
+    items = []
+    for r in rows[:limit]:
         d = dict(r)
-        d["content_ai"] = json.loads(d["content_ai_json"])
-        del d["content_ai_json"]
-        out.append(d)
-    return out
+        if include_content:
+            d["content_ai"] = json.loads(d.pop("content_ai_json"))
+        items.append(d)
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = _encode_cursor(last["last_activity_at"], last["id"])
+    return {"items": items, "next_cursor": next_cursor}
 
 
 def get_ku(ku_id: str) -> Optional[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM kus WHERE id = ? LIMIT 1", (ku_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = get_conn().execute("SELECT * FROM kus WHERE id = ? LIMIT 1", (ku_id,)).fetchone()
     if not row:
         return None
     d = dict(row)
@@ -121,63 +254,312 @@ def get_ku(ku_id: str) -> Optional[Dict[str, Any]]:
 
 
 def _active_kus_brief(project_id: str) -> List[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    rows = get_conn().execute("""
       SELECT id, title, type, status
       FROM kus
       WHERE project_id = ? AND status = 'Active'
       ORDER BY last_activity_at DESC
-    """, (project_id,))
-    rows = cur.fetchall()
-    conn.close()
+    """, (project_id,)).fetchall()
     return [dict(r) for r in rows]
 
 
-def _create_ku(project_id: str, title: str, ku_type: str) -> str:
-    ku_id = str(uuid4())
-    ts = now_ts()
-    content_ai = KUContent().model_dump()
-
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO kus (id, project_id, type, title, status, content_ai_json, content_human, created_at, last_activity_at)
-      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        ku_id, project_id, ku_type, sanitize_text(title)[:120] or "Тема",
-        "Active",
-        json.dumps(content_ai, ensure_ascii=False),
-        "",
-        ts,
-        ts
-    ))
-    conn.commit()
-    conn.close()
-    return ku_id
-
-
-def _ku_exists(ku_id: str) -> bool:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM kus WHERE id = ? LIMIT 1", (ku_id,))
-    ok = cur.fetchone() is not None
-    conn.close()
-    return ok
-
-
-def _update_ku_ai(ku_id: str, batch_text: str) -> None:
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("SELECT content_ai_json FROM kus WHERE id = ?", (ku_id,))
-    row = cur.fetchone()
-    if row is None:
-        conn.close()
+def _candidate_kus(project_id: str, batch_text: str,
+                   created: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Кандидаты для decide_ku_action: top-k похожих KU из локального индекса
+    вместо всех активных. Если лучший кандидат достаточно близок —
+    возвращает его id вторым элементом, и LLM для маршрутизации не нужен.
+    KU, созданные в этом же job'е (created — ещё не в БД и не в индексе), добавляются в конец.
+    """
+    if not settings.ku_index_enabled:
+        candidates, auto_target = _active_kus_brief(project_id), None
+    else:
+        hits = get_ku_index(project_id).search(batch_text, settings.ku_index_top_k)
+        candidates = [meta for meta, _ in hits]
+        auto_target = None
+        if hits and hits[0][1] >= settings.ku_index_auto_update_threshold:
+            auto_target = hits[0][0]["id"]
+
+    seen = {k["id"] for k in candidates}
+    candidates += [k for k in created if k["id"] not in seen]
+    return candidates, auto_target
+
+
+async def _with_contents(uow: "KUUnitOfWork", candidates: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """
+    Для single_call: добавляет текущий content_ai первым single_call_content_candidates
+    кандидатам. Второй элемент — снимки контента (JSON), на основе которых модель
+    считала контент (чтобы потом понять, не изменился ли KU за время вызова).
+    """
+    n = max(0, settings.single_call_content_candidates)
+    ids = [k["id"] for k in candidates[:n]]
+    await uow.aload(ids)
+    snapshots = {ku_id: uow.content_json(ku_id) for ku_id in ids if uow.exists(ku_id)}
+
+    out = []
+    for k in candidates:
+        k = dict(k)
+        if k["id"] in snapshots:
+            k["content_ai"] = json.loads(snapshots[k["id"]])
+        out.append(k)
+    return out, snapshots
+
+
+_EMPTY_CONTENT_JSON = json.dumps(KUContent().model_dump(), ensure_ascii=False)
+
+
+# -------------------------
+# Unit of work: все изменения KU одного job'а — в памяти, запись одной транзакцией
+# -------------------------
+class KUConflictError(Exception):
+    """KU изменил или удалил другой job, пока этот job его обрабатывал."""
+
+
+# сколько раз run_job переделывает изменения устаревших KU, прежде чем отдать job на повтор
+_COMMIT_ROUNDS = 3
+
+# read-modify-write одного KU сериализуется на весь процесс — и между темами
+# одного job'а, и между job'ами разных чатов, попавшими в общий KU проекта
+_ku_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _ku_lock(ku_id: str) -> asyncio.Lock:
+    lock = _ku_locks.get(ku_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _ku_locks[ku_id] = lock
+    return lock
+
+
+class KUUnitOfWork:
+    """
+    Копит изменения KU за обработку одного окна: затронутые KU читаются из БД
+    один раз, контент/заметки меняются в памяти, а commit() пишет всё
+    (новые KU, контент, last_activity_at) одной транзакцией.
+    Запись оптимистичная: UPDATE ... WHERE version = <прочитанная>; если KU
+    успел поменять другой job — KUConflictError, и run_job переделывает операции
+    только этого KU (update_ku_content / заметки, см. _ops) поверх свежей версии.
+    Контент в памяти всегда в пределах бюджетов (apply_budget): вытесненное
+    копится в _history и пишется в ku_history тем же коммитом.
+    Каждый записанный KU получает ревизию в ku_revisions (дельта к прочитанной
+    версии) с job_id и темами, которые его затронули.
+    """
+
+    def __init__(self, project_id: str, job_id: Optional[int] = None):
+        self.project_id = project_id
+        self.job_id = job_id
+        self._kus: Dict[str, Dict[str, Any]] = {}
+        self._missing: set = set()
+        self._created: List[str] = []
+        self._dirty: set = set()
+        self._history: Dict[str, List[Dict[str, str]]] = {}
+        # контент как он лежит в БД (до бюджета) — база для дельты ревизии
+        self._base: Dict[str, Dict[str, Any]] = {}
+        self._topics: Dict[str, List[str]] = {}
+        # операции над загруженными KU в порядке применения: ("update", batch_text) | ("note", text)
+        self._ops: Dict[str, List[Tuple[str, str]]] = {}
+
+    def lock(self, ku_id: str) -> asyncio.Lock:
+        return _ku_lock(ku_id)
+
+    def unloaded(self, ku_ids: List[str]) -> List[str]:
+        return [i for i in dict.fromkeys(ku_ids) if i and i not in self._kus and i not in self._missing]
+
+    @staticmethod
+    def load(ku_ids: List[str]) -> List[Dict[str, Any]]:
+        """Только чтение строк KU из БД (в пуле потоков БД); состояние uow не трогает."""
+        if not ku_ids:
+            return []
+        rows = get_conn().execute("""
+          SELECT id, project_id, title, type, status, content_ai_json, version
+          FROM kus WHERE id IN (SELECT value FROM json_each(?))
+        """, (json.dumps(ku_ids),)).fetchall()
+        return [dict(r) for r in rows]
+
+    def merge(self, ku_ids: List[str], rows: List[Dict[str, Any]]) -> None:
+        """
+        Вносит прочитанные строки в uow (в потоке event loop). KU, который
+        успела загрузить параллельная тема, не перезаписывается.
+        """
+        for ku in rows:
+            if ku["id"] in self._kus:
+                continue
+            self._kus[ku["id"]] = ku
+            self._base[ku["id"]] = json.loads(ku.pop("content_ai_json"))
+            # старые KU могут быть больше бюджета — в промпт уходит уже урезанный контент
+            self._set_budgeted(ku["id"], copy.deepcopy(self._base[ku["id"]]))
+        self._missing.update(set(ku_ids) - {r["id"] for r in rows} - set(self._kus))
+
+    async def aload(self, ku_ids: List[str]) -> None:
+        ids = self.unloaded(ku_ids)
+        if ids:
+            self.merge(ids, await run_db(self.load, ids))
+
+    def exists(self, ku_id: str) -> bool:
+        """Только по памяти: KU должен быть загружен (aload) заранее."""
+        return ku_id in self._kus
+
+    def content(self, ku_id: str) -> Dict[str, Any]:
+        return self._kus[ku_id]["content_ai"]
+
+    def content_json(self, ku_id: str) -> str:
+        return json.dumps(self.content(ku_id), ensure_ascii=False)
+
+    def created_briefs(self) -> List[Dict[str, Any]]:
+        return [{k: self._kus[i][k] for k in ("id", "title", "type", "status")} for i in self._created]
+
+    def create(self, title: str, ku_type: str) -> str:
+        ku_id = str(uuid4())
+        self._kus[ku_id] = {
+            "id": ku_id,
+            "project_id": self.project_id,
+            "title": sanitize_text(title)[:120] or "Тема",
+            "type": ku_type,
+            "status": "Active",
+            "content_ai": KUContent().model_dump(),
+            "version": 1,
+        }
+        self._created.append(ku_id)
+        self._dirty.add(ku_id)
+        return ku_id
+
+    def _set_budgeted(self, ku_id: str, content: Dict[str, Any]) -> None:
+        content, rolled = apply_budget(content)
+        self._kus[ku_id]["content_ai"] = content
+        if rolled:
+            self._history.setdefault(ku_id, []).extend(rolled)
+
+    def set_content(self, ku_id: str, content: Dict[str, Any]) -> None:
+        self._set_budgeted(ku_id, content)
+        self._dirty.add(ku_id)
+
+    def add_note(self, ku_id: str, note: str) -> None:
+        if not self.exists(ku_id):
+            return
+        content = dict(self._kus[ku_id]["content_ai"])
+        content["notes"] = [*content.get("notes", []), sanitize_text(note)]
+        self._set_budgeted(ku_id, content)
+        self._dirty.add(ku_id)
+        self.record(ku_id, "note", note)
+
+    def record(self, ku_id: str, kind: str, arg: str) -> None:
+        if ku_id not in self._created:
+            self._ops.setdefault(ku_id, []).append((kind, arg))
+
+    def touched(self) -> List[str]:
+        """Загруженные (не созданные в job'е) KU, которые job менял."""
+        return list(self._ops)
+
+    def stale(self, rows: List[Dict[str, Any]]) -> List[str]:
+        """Изменённые KU, чья версия в БД (rows) ушла вперёд прочитанной."""
+        versions = {r["id"]: r["version"] for r in rows}
+        return [i for i in self._ops if versions.get(i) != self._kus[i]["version"]]
+
+    def reset(self, ku_id: str, row: Dict[str, Any]) -> List[Tuple[str, str]]:
+        """Заменяет KU свежей строкой из БД и возвращает его операции для повторного применения."""
+        self._kus.pop(ku_id, None)
+        self._history.pop(ku_id, None)
+        self.merge([ku_id], [row])
+        return self._ops.pop(ku_id, [])
+
+    def add_topic(self, ku_id: str, topic: str) -> None:
+        """Тема окна, попавшая в KU, — для ревизии."""
+        topics = self._topics.setdefault(ku_id, [])
+        if topic not in topics:
+            topics.append(topic)
+
+    def commit(self) -> None:
+        """Пишет изменения; вызывать внутри transaction() — вложенный вызов присоединяется к внешней."""
+        if not self._dirty:
+            return
+        ts = now_ts()
+        created = set(self._created)
+        with transaction() as conn:
+            conn.executemany("""
+              INSERT INTO kus (id, project_id, type, title, status, content_ai_json, summary, content_human,
+                               created_at, last_activity_at, version)
+              VALUES (?, ?, ?, ?, ?, ?, ?, '', ?, ?, 1)
+            """, [
+                (k["id"], k["project_id"], k["type"], k["title"], k["status"],
+                 json.dumps(k["content_ai"], ensure_ascii=False), k["content_ai"].get("summary") or "", ts, ts)
+                for k in (self._kus[i] for i in self._created)
+            ])
+
+            for ku_id in self._dirty - created:
+                if not self._update(conn, ku_id, ts):
+                    raise KUConflictError(f"KU {ku_id} was modified concurrently")
+
+            # история пишется только вместе с контентом; у незатронутых KU урезание не сохраняется
+            for ku_id in self._dirty:
+                k = self._kus[ku_id]
+                write_history(conn, ku_id, self._history.get(ku_id, []), ts)
+                write_revision(conn, ku_id, 1 if ku_id in created else k["version"] + 1,
+                               self._base.get(ku_id), k["content_ai"], self.job_id,
+                               self._topics.get(ku_id, []), ts)
+
+    def _update(self, conn: sqlite3.Connection, ku_id: str, ts: int) -> bool:
+        k = self._kus[ku_id]
+        cur = conn.execute("""
+          UPDATE kus SET content_ai_json = ?, summary = ?, last_activity_at = ?, version = version + 1
+          WHERE id = ? AND version = ?
+        """, (json.dumps(k["content_ai"], ensure_ascii=False), k["content_ai"].get("summary") or "",
+              ts, ku_id, k["version"]))
+        return cur.rowcount == 1
+
+    def publish(self) -> None:
+        """После коммита: инкрементально обновляет индекс KU."""
+        for ku_id in self._dirty:
+            k = self._kus[ku_id]
+            index_ku(k["project_id"], ku_id, k["title"], k["type"], k["status"], k["content_ai"])
+
+
+def restore_ku_revision(ku_id: str, version: int) -> Optional[Dict[str, Any]]:
+    """
+    Откат content_ai KU к ревизии version — новой ревизией поверх текущей
+    (история не переписывается). None — нет такого KU или ревизии.
+    """
+    ku = get_ku(ku_id)
+    rev = reconstruct(ku_id, version) if ku else None
+    if rev is None:
+        return None
+
+    uow = KUUnitOfWork(ku["project_id"])
+    uow.merge([ku_id], uow.load([ku_id]))
+    uow.set_content(ku_id, rev["content_ai"])
+    uow.add_topic(ku_id, f"restore v{version}")
+    with transaction():
+        uow.commit()
+    uow.publish()
+    return get_ku(ku_id)
+
+
+async def _update_ku_ai(uow: KUUnitOfWork, ku_id: str, batch_text: str,
+                        proposed: Optional[Dict[str, Any]] = None, based_on: Optional[str] = None) -> None:
+    """
+    proposed — контент, уже посчитанный моделью (режим single_call) по снимку based_on.
+    Он применяется, только если KU с тех пор не менялся и контент валиден как KUContent;
+    иначе — обычный update_ku_content.
+    """
+    await uow.aload([ku_id])
+    async with uow.lock(ku_id):
+        await _apply_update(uow, ku_id, batch_text, proposed, based_on)
+
+
+async def _apply_update(uow: KUUnitOfWork, ku_id: str, batch_text: str,
+                        proposed: Optional[Dict[str, Any]] = None, based_on: Optional[str] = None) -> None:
+    """Тело _update_ku_ai; вызывать под uow.lock(ku_id)."""
+    if not uow.exists(ku_id):
         return
 
-    existing = json.loads(row["content_ai_json"])
-    updated = update_ku_content(existing, batch_text)
+    existing = copy.deepcopy(uow.content(ku_id))
+    updated = None
+    if proposed is not None and based_on == uow.content_json(ku_id):
+        try:
+            updated = KUContent.model_validate(proposed).model_dump()
+        except ValidationError:
+            updated = None
+    if updated is None:
+        updated = await aupdate_ku_content(existing, batch_text)
 
     if "_error" in updated:
         existing.setdefault("notes", []).append(f"LLM error: {updated.get('_error')}")
@@ -188,41 +570,33 @@ def _update_ku_ai(ku_id: str, batch_text: str) -> None:
             updated["summary"] = sanitize_text(batch_text.splitlines()[0])[:200]
         new_content = KUContent(**updated).model_dump()
 
-    cur.execute("""
-      UPDATE kus
-      SET content_ai_json = ?, last_activity_at = ?
-      WHERE id = ?
-    """, (json.dumps(new_content, ensure_ascii=False), now_ts(), ku_id))
+    uow.set_content(ku_id, new_content)
+    uow.record(ku_id, "update", batch_text)
 
-    conn.commit()
-    conn.close()
 
+async def _append_note_to_ku(uow: KUUnitOfWork, ku_id: str, note: str) -> None:
+    await uow.aload([ku_id])
+    async with uow.lock(ku_id):
+        uow.add_note(ku_id, note)
 
-def _append_note_to_ku(ku_id: str, note: str) -> None:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT content_ai_json FROM kus WHERE id = ?", (ku_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return
-    content = json.loads(row["content_ai_json"])
-    content.setdefault("notes", []).append(sanitize_text(note))
-    cur.execute(
-        "UPDATE kus SET content_ai_json=?, last_activity_at=? WHERE id=?",
-        (json.dumps(content, ensure_ascii=False), now_ts(), ku_id)
-    )
-    conn.commit()
-    conn.close()
 
+async def process_batch(uow: KUUnitOfWork, batch_text: str) -> Dict[str, str]:
+    active, auto_target = await run_db(_candidate_kus, uow.project_id, batch_text, uow.created_briefs())
+    snapshots: Dict[str, str] = {}
+    if auto_target:
+        decision = {"action": "update_ku", "target_ku_id": auto_target, "reason": "ku_index"}
+    elif settings.pipeline_mode == "single_call":
+        # маршрут + готовый контент одним вызовом
+        active, snapshots = await _with_contents(uow, active)
+        decision = await aroute_and_update(batch_text, active)
+    else:
+        decision = await adecide_ku_action(batch_text, active)
 
-def process_batch(project_id: str, batch_text: str) -> Dict[str, str]:
-    active = _active_kus_brief(project_id)
-    decision = decide_ku_action(batch_text, active)
+    proposed = decision.get("content") if isinstance(decision.get("content"), dict) else None
 
     if decision.get("_error"):
-        ku_id = _create_ku(project_id, "Батч (auto)", "Discussion")
-        _update_ku_ai(ku_id, batch_text)
+        ku_id = uow.create("Батч (auto)", "Discussion")
+        await _update_ku_ai(uow, ku_id, batch_text)
         return {"action": "create_ku_fallback", "ku_id": ku_id}
 
     action = decision.get("action", "noop")
@@ -238,127 +612,290 @@ def process_batch(project_id: str, batch_text: str) -> Dict[str, str]:
         new_ku = decision.get("new_ku") or {}
         title = (new_ku.get("title") or "Тема").strip()
         ku_type = (new_ku.get("type") or "Discussion").strip()
-        ku_id = _create_ku(project_id, title, ku_type)
-        _update_ku_ai(ku_id, batch_text)
+        ku_id = uow.create(title, ku_type)
+        await _update_ku_ai(uow, ku_id, batch_text, proposed, _EMPTY_CONTENT_JSON)
         return {"action": "create_ku", "ku_id": ku_id}
 
     if action == "update_ku":
         target = decision.get("target_ku_id")
-        if target and _ku_exists(target):
-            _update_ku_ai(target, batch_text)
-            return {"action": "update_ku", "ku_id": target}
-
-        ku_id = _create_ku(project_id, "Батч (auto)", "Discussion")
-        _update_ku_ai(ku_id, batch_text)
+        if target:
+            await uow.aload([target])
+        if target and uow.exists(target):
+            await _update_ku_ai(uow, target, batch_text, proposed, snapshots.get(target))
+            return {"action": "update_ku_index" if auto_target else "update_ku", "ku_id": target}
+
+        ku_id = uow.create("Батч (auto)", "Discussion")
+        await _update_ku_ai(uow, ku_id, batch_text)
         return {"action": "update_missing_fallback", "ku_id": ku_id}
 
-    ku_id = _create_ku(project_id, "Батч (auto)", "Discussion")
-    _update_ku_ai(ku_id, batch_text)
+    ku_id = uow.create("Батч (auto)", "Discussion")
+    await _update_ku_ai(uow, ku_id, batch_text)
     return {"action": "unknown_fallback", "ku_id": ku_id}
 
 
-def finalize_due_batches(batch_window_seconds: int) -> List[Dict[str, Any]]:
+async def _process_topic(uow: KUUnitOfWork, t: Dict[str, Any],
+                         drop_count: Optional[int], note: str) -> Optional[Dict[str, Any]]:
+    title = sanitize_text((t.get("title") or "Тема").strip())[:120]
+    cleaned = sanitize_text((t.get("cleaned_text") or "").strip())
+
+    if not cleaned:
+        return None
+
+    # подсказка модели про тему
+    decorated = f"[ТЕМА: {title}]\n{cleaned}"
+
+    p = await process_batch(uow, decorated)
+
+    ku_id = p.get("ku_id")
+    if ku_id:
+        uow.add_topic(ku_id, title)
+        if drop_count:
+            await _append_note_to_ku(uow, ku_id, f"AI-фильтр: удалено ~{drop_count} строк шума (на батч).")
+        if note:
+            await _append_note_to_ku(uow, ku_id, f"AI-фильтр note: {note}")
+
+    return {"topic": title, "pipeline": p}
+
+
+async def _select_topics(lines: List[str]) -> Dict[str, Any]:
     """
-    Закрывает батчи по таймеру.
-    Делает AI-фильтр и разбивает батч на topics → по каждой теме создаёт/обновляет KU.
+    select_relevant с map-reduce: батч режется по границам сообщений на чанки
+    не больше select_chunk_tokens, чанки фильтруются параллельно, темы сливаются.
+    Упавший чанк не теряется — уходит целиком как отдельная тема-фолбэк
+    (в слияние не попадает, чтобы фолбэки не склеились в один огромный промпт).
     """
-    project = get_or_create_default_project()
-    project_id = project["id"]
+    chunks = split_into_chunks(lines, settings.select_chunk_tokens)
+    results = await asyncio.gather(*[aselect_relevant("\n".join(c)) for c in chunks])
+
+    topics: List[Dict[str, Any]] = []
+    fallbacks: List[Dict[str, Any]] = []
+    drop_count: Optional[int] = 0
+    notes: List[str] = []
+
+    for i, (chunk, sel) in enumerate(zip(chunks, results), 1):
+        if sel.get("_error"):
+            title = f"Батч {i}" if len(chunks) > 1 else "Батч"
+            fallbacks.append({"title": title, "type": "Discussion", "cleaned_text": "\n".join(chunk)})
+            drop_count = None
+            notes.append(f"AI-фильтр упал: {sel.get('_error')}")
+            continue
 
-    conn = get_conn()
-    cur = conn.cursor()
+        topics.extend(sel.get("topics") or [])
+        if drop_count is not None:
+            try:
+                drop_count += int(sel.get("drop_count") or 0)
+            except (TypeError, ValueError):
+                pass
+        if sel.get("notes"):
+            notes.append(sel["notes"])
 
-    now = now_ts()
-    cur.execute("SELECT chat_id, started_at FROM open_batches")
-    batches = cur.fetchall()
+    if len(chunks) > 1:
+        topics = merge_topics(topics)
 
-    results: List[Dict[str, Any]] = []
+    return {
+        "topics": topics + fallbacks,
+        "drop_count": drop_count,
+        "notes": " | ".join(dict.fromkeys(notes)),
+        "chunks": len(chunks),
+    }
 
-    for b in batches:
-        chat_id = b["chat_id"]
-        started_at = b["started_at"]
 
-        if now - started_at < batch_window_seconds:
+async def process_job(uow: KUUnitOfWork, job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Обработка одного закрытого окна чата (job из batch_jobs).
+    Изменения KU только копятся в uow — записывает их run_job.
+    Исключения не глотает — ими управляет очередь (retry / failed).
+    """
+    chat_id = job["chat_id"]
+    msgs = await run_db(load_job_messages, job)
+
+    # собираем сырой батч
+    entries = []
+    for m in msgs:
+        user = m["user_name"] or m["user_id"] or "user"
+        text = sanitize_text((m["text"] or "").strip())
+        if not text:
             continue
+        entries.append((user, text, m["user_id"] or user))
 
-        cur.execute("""
-          SELECT user_name, user_id, text, created_at
-          FROM messages
-          WHERE chat_id = ? AND created_at >= ?
-          ORDER BY created_at ASC
-        """, (chat_id, started_at))
-        msgs = cur.fetchall()
-
-        # закрываем батч сразу
-        cur.execute("DELETE FROM open_batches WHERE chat_id = ?", (chat_id,))
-        conn.commit()
-
-        # собираем сырой батч
-        lines = []
-        for m in msgs:
-            user = m["user_name"] or m["user_id"] or "user"
-            text = sanitize_text((m["text"] or "").strip())
-            if not text:
-                continue
-            lines.append(f"{user}: {text}")
-        raw_text = "\n".join(lines).strip()
+    # локальный пре-фильтр очевидного шума — не платим за него токенами
+    noise: Dict[str, int] = {}
+    if settings.noise_filter_enabled:
+        keep, noise = filter_noise([text for _, text, _ in entries], [who for _, _, who in entries])
+        entries = [entries[i] for i in keep]
+    noise_dropped = sum(noise.values())
 
-        if not raw_text:
-            results.append({"chat_id": chat_id, "status": "empty_batch", "messages": len(msgs)})
-            continue
+    lines = [f"{user}: {text}" for user, text, _ in entries]
+
+    if not lines:
+        return {"chat_id": chat_id, "status": "empty_batch", "messages": len(msgs), "noise_dropped": noise_dropped}
+
+    # 1) AI-фильтр + темы (большие батчи — по чанкам, без обрезки хвоста)
+    sel = await _select_topics(lines)
+    topics = sel["topics"]
+    drop_count = sel["drop_count"]
+    note = sel["notes"]
 
-        # ограничение на размер
-        MAX_CHARS = 12000
-        if len(raw_text) > MAX_CHARS:
-            raw_text = raw_text[:MAX_CHARS] + "\n[...обрезано...]"
+    if drop_count is not None:
+        drop_count += noise_dropped
 
-        conn.close()
+    if not topics:
+        return {"chat_id": chat_id, "status": "empty_after_ai_filter", "messages": len(msgs),
+                "noise_dropped": noise_dropped}
+
+    # 2) темы независимы — гоняем параллельно; изменения одного KU сериализует _ku_lock
+    done = await asyncio.gather(*[_process_topic(uow, t, drop_count, note) for t in topics])
+    pipelines = [p for p in done if p is not None]
+
+    return {"chat_id": chat_id, "status": "processed", "pipelines": pipelines, "messages": len(msgs),
+            "noise_dropped": noise_dropped, "noise": noise, "chunks": sel["chunks"]}
+
+
+def _commit_job(uow: KUUnitOfWork, job: Dict[str, Any], result: Dict[str, Any]) -> None:
+    # изменения KU и отметка done — одной транзакцией: job применяется целиком или никак
+    with transaction():
+        uow.commit()
+        mark_messages_processed(job)
+        if not complete_job(job["id"], result):
+            raise RuntimeError("job lease lost")
+
+
+async def _redo_stale_kus(uow: KUUnitOfWork) -> None:
+    """
+    KU, которые другой job успел закоммитить после нашего чтения: перечитываем
+    и заново применяем к свежему контенту только операции этого job'а
+    (update_ku_content видит чужие правки, а не затирает их). Остальной job не повторяется.
+    """
+    rows = await run_db(uow.load, uow.touched())
+    fresh = {r["id"]: r for r in rows}
+    for ku_id in uow.stale(rows):
+        if ku_id not in fresh:
+            raise KUConflictError(f"KU {ku_id} was deleted concurrently")
+        async with uow.lock(ku_id):
+            for kind, arg in uow.reset(ku_id, fresh[ku_id]):
+                if kind == "update":
+                    await _apply_update(uow, ku_id, arg)
+                else:
+                    uow.add_note(ku_id, arg)
+
+
+async def _commit_with_redo(uow: KUUnitOfWork, job: Dict[str, Any], result: Dict[str, Any]) -> None:
+    for attempt in range(_COMMIT_ROUNDS):
         try:
-            # 1) AI-фильтр + темы
-            sel = select_relevant(raw_text)
-
-            if sel.get("_error"):
-                topics = [{"title": "Батч", "type": "Discussion", "cleaned_text": raw_text}]
-                drop_count = None
-                note = f"AI-фильтр упал: {sel.get('_error')}"
-            else:
-                topics = sel.get("topics") or []
-                drop_count = sel.get("drop_count")
-                note = sel.get("notes") or ""
-
-            if not topics:
-                results.append({"chat_id": chat_id, "status": "empty_after_ai_filter", "messages": len(msgs)})
-                continue
+            await run_db(_commit_job, uow, job, result)
+            return
+        except KUConflictError:
+            if attempt + 1 == _COMMIT_ROUNDS:
+                raise
+            await _redo_stale_kus(uow)
 
-            pipelines = []
-            for t in topics:
-                title = sanitize_text((t.get("title") or "Тема").strip())[:120]
-                ku_type = (t.get("type") or "Discussion").strip()
-                cleaned = sanitize_text((t.get("cleaned_text") or "").strip())
 
-                if not cleaned:
-                    continue
+async def run_job(project_id: str, job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Выполняет захваченный job: продлевает lease, пока идёт работа,
+    и по итогу переводит job в done или обратно в pending/failed. Недоступность
+    провайдера LLM попыткой не считается — job откладывается до сброса breaker'а.
+    """
+    async def heartbeat() -> None:
+        while True:
+            await asyncio.sleep(max(1, settings.job_lease_seconds // 3))
+            await run_db(renew_lease, job["id"])
+
+    uow = KUUnitOfWork(project_id, job["id"])
+    hb = asyncio.create_task(heartbeat())
+    try:
+        result = await process_job(uow, job)
+        await _commit_with_redo(uow, job, result)
+    except LLMUnavailableError as e:
+        # провайдер лежит (breaker открыт / ретраи исчерпаны): ждём сброса breaker'а, попытку не тратим
+        state = await run_db(defer_job, job["id"], str(e), get_governor().retry_after_seconds())
+        return {"job_id": job["id"], "chat_id": job["chat_id"], "status": "deferred", "job_state": state,
+                "attempts": job["attempts"], "error": str(e)}
+    except Exception as e:
+        state = await run_db(fail_job, job["id"], str(e))
+        return {"job_id": job["id"], "chat_id": job["chat_id"], "status": "error", "job_state": state,
+                "attempts": job["attempts"], "error": str(e)}
+    finally:
+        hb.cancel()
+
+    uow.publish()
+    return {"job_id": job["id"], **result}
+
+
+def open_batches_fingerprint() -> Tuple[int, int, int, int]:
+    """
+    Дешёвый «отпечаток» open_batches (таблица маленькая — строка на открытое окно):
+    меняется, когда любой процесс открывает, дополняет или закрывает окно.
+    """
+    row = get_conn().execute("""
+      SELECT COUNT(*), COALESCE(SUM(started_at), 0), COALESCE(SUM(message_count), 0),
+             COALESCE(MAX(last_message_at), 0)
+      FROM open_batches
+    """).fetchone()
+    return tuple(row)
+
+
+def list_open_batches() -> List[Dict[str, Any]]:
+    """Открытые окна с посчитанным по политике чата дедлайном закрытия."""
+    batches = [dict(r) for r in get_conn().execute("SELECT * FROM open_batches").fetchall()]
+    policies = get_chat_policies(b["chat_id"] for b in batches)
+    for b in batches:
+        b["deadline"] = batch_deadline(b, policies[b["chat_id"]])
+    return batches
 
-                # подсказка модели про тему
-                decorated = f"[ТЕМА: {title}]\n{cleaned}"
 
-                p = process_batch(project_id, decorated)
-                pipelines.append({"topic": title, "pipeline": p})
+def close_batch_if_due(chat_id: str) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    """
+    Проверяет окно чата по свежим данным из БД (сообщения могли прийти через другой процесс)
+    и закрывает его, если дедлайн наступил. Возвращает (job_id, None) при закрытии,
+    (None, batch) если окно ещё открыто (batch["deadline"] — новый дедлайн), (None, None) если окна нет.
+    """
+    row = get_conn().execute("SELECT * FROM open_batches WHERE chat_id = ?", (chat_id,)).fetchone()
+    if row is None:
+        return None, None
+
+    batch = dict(row)
+    batch["deadline"] = batch_deadline(batch, get_chat_policies([chat_id])[chat_id])
+    if batch["deadline"] > now_ts():
+        return None, batch
+
+    job_id = close_batch(chat_id, batch["started_at"])
+    return job_id, None
+
+
+def close_due_batches() -> List[int]:
+    """Закрывает окна, у которых наступил дедлайн по политике чата, и ставит по job'у на каждое."""
+    now = now_ts()
+    job_ids = []
+    for b in list_open_batches():
+        if b["deadline"] > now:
+            continue
+        job_id = close_batch(b["chat_id"], b["started_at"])
+        if job_id is not None:
+            job_ids.append(job_id)
+    return job_ids
 
-                ku_id = p.get("ku_id")
-                if ku_id:
-                    if drop_count is not None:
-                        _append_note_to_ku(ku_id, f"AI-фильтр: удалено ~{drop_count} строк шума (на батч).")
-                    if note:
-                        _append_note_to_ku(ku_id, f"AI-фильтр note: {note}")
 
-            results.append({"chat_id": chat_id, "status": "processed", "pipelines": pipelines, "messages": len(msgs)})
+async def drain_jobs(project_id: str) -> List[Dict[str, Any]]:
+    """Разбирает все готовые job'ы, не больше finalize_concurrency одновременно."""
+    results: List[Dict[str, Any]] = []
 
-        except Exception as e:
-            results.append({"chat_id": chat_id, "status": "error", "error": str(e)})
-        finally:
-            conn = get_conn()
-            cur = conn.cursor()
+    async def worker() -> None:
+        while True:
+            job = await run_db(claim_job)
+            if job is None:
+                return
+            results.append(await run_job(project_id, job))
 
-    conn.close()
+    await asyncio.gather(*[worker() for _ in range(max(1, settings.finalize_concurrency))])
     return results
+
+
+async def finalize_due_batches() -> List[Dict[str, Any]]:
+    """
+    Закрывает батчи с наступившим дедлайном (job в batch_jobs на каждое окно) и сразу их обрабатывает.
+    Делает AI-фильтр и разбивает батч на topics → по каждой теме создаёт/обновляет KU.
+    """
+    project = await run_db(get_or_create_default_project)
+    await run_db(close_due_batches)
+    return await drain_jobs(project["id"])
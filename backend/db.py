@@ -1,60 +1,135 @@
+import asyncio
+import functools
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional, TypeVar
+
 from config import settings
 
 
+class ConnectionManager:
+    """
+    Держит по одному постоянному соединению на поток (thread-local).
+    Соединение открывается один раз, настраивается pragma'ми (WAL и т.д.)
+    и переиспользуется — вместе с кэшем подготовленных выражений sqlite3.
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns: List[sqlite3.Connection] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self._db_path,
+            check_same_thread=False,
+            timeout=settings.db_busy_timeout_ms / 1000,
+            # транзакции открываем явно через transaction()
+            isolation_level=None,
+            cached_statements=settings.db_cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={settings.db_synchronous}")
+        conn.execute(f"PRAGMA cache_size={-int(settings.db_cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(settings.db_mmap_size)}")
+        conn.execute(f"PRAGMA busy_timeout={int(settings.db_busy_timeout_ms)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def close_all(self) -> None:
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+
+_manager = ConnectionManager(settings.db_path)
+
+
 def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(settings.db_path, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Постоянное соединение текущего потока. Закрывать его не нужно —
+    этим занимается close_db() при остановке.
+    """
+    return _manager.get()
 
 
-def init_db() -> None:
+@contextmanager
+def transaction(immediate: bool = True) -> Iterator[sqlite3.Connection]:
+    """
+    Одна транзакция на блок: commit при выходе, rollback при исключении.
+    BEGIN IMMEDIATE сразу берёт write-lock, чтобы писатели ждали busy_timeout,
+    а не падали на апгрейде блокировки. Вложенные вызовы идут во внешнюю транзакцию.
+    """
     conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS projects (
-      id TEXT PRIMARY KEY,
-      name TEXT NOT NULL,
-      short_context TEXT NOT NULL,
-      project_summary TEXT NOT NULL DEFAULT '',
-      status TEXT NOT NULL DEFAULT 'active'
-    );
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS kus (
-      id TEXT PRIMARY KEY,
-      project_id TEXT,
-      type TEXT NOT NULL,
-      title TEXT NOT NULL,
-      status TEXT NOT NULL,
-      content_ai_json TEXT NOT NULL,
-      content_human TEXT NOT NULL DEFAULT '',
-      created_at INTEGER NOT NULL,
-      last_activity_at INTEGER NOT NULL
-    );
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      chat_id TEXT NOT NULL,
-      user_id TEXT,
-      user_name TEXT,
-      message_id TEXT,
-      sent_at INTEGER,
-      text TEXT NOT NULL,
-      created_at INTEGER NOT NULL
-    );
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS open_batches (
-      chat_id TEXT PRIMARY KEY,
-      started_at INTEGER NOT NULL
-    );
-    """)
-
-    conn.commit()
-    conn.close()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+# -------------------------
+# Async-фасад: блокирующие вызовы sqlite3 — в отдельном пуле потоков БД
+# -------------------------
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # у каждого потока пула своё постоянное соединение (ConnectionManager)
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, settings.db_executor_threads),
+                thread_name_prefix="db",
+            )
+        return _executor
+
+
+async def run_db(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Выполняет синхронную функцию доступа к БД в пуле потоков БД и ждёт результат,
+    не блокируя event loop. Читатели в WAL идут параллельно, писатели
+    сериализует сам SQLite (BEGIN IMMEDIATE + busy_timeout).
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def close_db() -> None:
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    _manager.close_all()
+
@@ -0,0 +1,115 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.crud_sqlite import insert_messages
+from backend.db import run_db
+
+
+class IngestBuffer:
+    """
+    Write-behind буфер входящих сообщений (group commit).
+    Сообщения копятся в памяти и пишутся одной транзакцией через insert_messages
+    раз в flush_ms или как только набралось max_batch штук.
+    submit() возвращает started_new_batch уже после коммита, так что ответ
+    клиенту по-прежнему означает «сообщение сохранено».
+    """
+
+    def __init__(self, flush_ms: int = 50, max_batch: int = 500):
+        self._flush_seconds = flush_ms / 1000
+        self._max_batch = max_batch
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._has_items: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._has_items = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает буфер, предварительно сбросив всё накопленное."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._has_items.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def submit(self, item: Dict[str, Any]) -> bool:
+        return (await self.submit_many([item]))[0]
+
+    async def submit_many(self, items: List[Dict[str, Any]]) -> List[bool]:
+        if not items:
+            return []
+        if self._task is None or self._stopping:
+            # буфер не запущен (или уже останавливается) — пишем напрямую
+            return await run_db(insert_messages, items)
+
+        futures = []
+        for item in items:
+            fut = self._loop.create_future()
+            self._pending.append((item, fut))
+            futures.append(fut)
+
+        self._has_items.set()
+        if len(self._pending) >= self._max_batch:
+            self._full.set()
+        return list(await asyncio.gather(*futures))
+
+    async def submit_threadsafe(self, items: List[Dict[str, Any]]) -> List[bool]:
+        """
+        submit_many для вызова из другого event loop (бот в том же процессе,
+        но в своём потоке): корутина планируется в loop буфера.
+        """
+        loop = self._loop
+        if loop is None or loop is asyncio.get_running_loop() or loop.is_closed():
+            return await self.submit_many(items)
+        fut = asyncio.run_coroutine_threadsafe(self.submit_many(items), loop)
+        return await asyncio.wrap_future(fut)
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_items.wait()
+
+            if not self._stopping and len(self._pending) < self._max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self._flush_seconds)
+                except asyncio.TimeoutError:
+                    pass
+
+            while self._pending:
+                chunk = self._pending[:self._max_batch]
+                del self._pending[:self._max_batch]
+                await self._flush(chunk)
+
+            self._has_items.clear()
+            self._full.clear()
+            if self._stopping:
+                return
+
+    async def _flush(self, chunk: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        items = [item for item, _ in chunk]
+        try:
+            flags = await run_db(insert_messages, items)
+        except Exception as e:
+            print("Ingest flush error:", e)
+            for _, fut in chunk:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for (_, fut), flag in zip(chunk, flags):
+            if not fut.done():
+                fut.set_result(flag)
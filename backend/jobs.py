@@ -0,0 +1,184 @@
+import json
+import math
+import os
+import socket
+import time
+from typing import Any, Dict, Optional
+from uuid import uuid4
+
+from backend.db import get_conn, transaction
+from config import settings
+
+
+# Идентификатор этого процесса как владельца lease'ов
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+def now_ts() -> int:
+    return int(time.time())
+
+
+# -------------------------
+# Batch jobs: pending → running → done | failed
+# -------------------------
+def close_batch(chat_id: str, started_at: int) -> Optional[int]:
+    """
+    Закрывает окно чата и ставит job на его обработку — одной транзакцией.
+    Окно фиксируется по id сообщений: (after_message_id, max_message_id],
+    так что сообщения, пришедшие после закрытия, уже точно попадут в следующий батч.
+    Возвращает id job'а или None, если окно уже закрыл кто-то другой.
+    """
+    with transaction() as conn:
+        cur = conn.execute(
+            "DELETE FROM open_batches WHERE chat_id = ? AND started_at = ?",
+            (chat_id, started_at)
+        )
+        if cur.rowcount == 0:
+            return None
+
+        max_id = conn.execute(
+            "SELECT COALESCE(MAX(id), 0) AS m FROM messages WHERE chat_id = ?", (chat_id,)
+        ).fetchone()["m"]
+        after_id = conn.execute(
+            "SELECT COALESCE(MAX(max_message_id), 0) AS m FROM batch_jobs WHERE chat_id = ?", (chat_id,)
+        ).fetchone()["m"]
+
+        ts = now_ts()
+        cur = conn.execute("""
+          INSERT INTO batch_jobs (chat_id, window_start, window_end, after_message_id, max_message_id,
+                                  state, attempts, available_at, created_at, updated_at)
+          VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?)
+        """, (chat_id, started_at, ts, after_id, max_id, ts, ts, ts))
+        return cur.lastrowid
+
+
+def claim_job(owner: str = WORKER_ID, lease_seconds: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Берёт следующий job: pending, у которого подошло available_at, или running
+    с истёкшим lease (воркер упал/процесс перезапущен). Выбор и захват идут
+    под write-lock'ом, поэтому один job не достанется двум воркерам.
+    """
+    lease = lease_seconds or settings.job_lease_seconds
+    now = now_ts()
+    with transaction() as conn:
+        row = conn.execute("""
+          SELECT id FROM batch_jobs
+          WHERE (state = 'pending' AND available_at <= ?)
+             OR (state = 'running' AND lease_expires_at < ?)
+          ORDER BY id
+          LIMIT 1
+        """, (now, now)).fetchone()
+        if row is None:
+            return None
+
+        conn.execute("""
+          UPDATE batch_jobs
+          SET state = 'running', attempts = attempts + 1,
+              lease_owner = ?, lease_expires_at = ?, updated_at = ?
+          WHERE id = ?
+        """, (owner, now + lease, now, row["id"]))
+
+        job = conn.execute("SELECT * FROM batch_jobs WHERE id = ?", (row["id"],)).fetchone()
+    return dict(job)
+
+
+def renew_lease(job_id: int, owner: str = WORKER_ID, lease_seconds: Optional[int] = None) -> bool:
+    lease = lease_seconds or settings.job_lease_seconds
+    now = now_ts()
+    with transaction() as conn:
+        cur = conn.execute("""
+          UPDATE batch_jobs SET lease_expires_at = ?, updated_at = ?
+          WHERE id = ? AND state = 'running' AND lease_owner = ?
+        """, (now + lease, now, job_id, owner))
+        return cur.rowcount == 1
+
+
+def complete_job(job_id: int, result: Dict[str, Any], owner: str = WORKER_ID) -> bool:
+    with transaction() as conn:
+        cur = conn.execute("""
+          UPDATE batch_jobs
+          SET state = 'done', result_json = ?, last_error = NULL,
+              lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+          WHERE id = ? AND lease_owner = ?
+        """, (json.dumps(result, ensure_ascii=False), now_ts(), job_id, owner))
+        return cur.rowcount == 1
+
+
+def fail_job(job_id: int, error: str, owner: str = WORKER_ID) -> str:
+    """
+    Ошибка обработки: job возвращается в pending с экспоненциальной задержкой,
+    после job_max_attempts попыток — failed. Возвращает новое состояние.
+    """
+    now = now_ts()
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT attempts FROM batch_jobs WHERE id = ? AND lease_owner = ?", (job_id, owner)
+        ).fetchone()
+        if row is None:
+            return "lost_lease"
+
+        if row["attempts"] >= settings.job_max_attempts:
+            state, available_at = "failed", now
+        else:
+            state = "pending"
+            available_at = now + settings.job_retry_base_seconds * (2 ** (row["attempts"] - 1))
+
+        conn.execute("""
+          UPDATE batch_jobs
+          SET state = ?, last_error = ?, available_at = ?,
+              lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+          WHERE id = ?
+        """, (state, error[:2000], available_at, now, job_id))
+    return state
+
+
+def defer_job(job_id: int, error: str, delay_seconds: float, owner: str = WORKER_ID) -> str:
+    """
+    Провайдер LLM недоступен — это не ошибка job'а: он возвращается в pending
+    на delay_seconds, и попытка, списанная claim_job, не засчитывается.
+    """
+    now = now_ts()
+    with transaction() as conn:
+        cur = conn.execute("""
+          UPDATE batch_jobs
+          SET state = 'pending', attempts = MAX(attempts - 1, 0), last_error = ?, available_at = ?,
+              lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+          WHERE id = ? AND lease_owner = ?
+        """, (error[:2000], now + int(math.ceil(delay_seconds)), now, job_id, owner))
+    return "pending" if cur.rowcount == 1 else "lost_lease"
+
+
+def retry_failed_jobs() -> int:
+    """Возвращает failed job'ы в очередь (после починки причины) — с чистым счётчиком попыток."""
+    now = now_ts()
+    with transaction() as conn:
+        cur = conn.execute("""
+          UPDATE batch_jobs SET state = 'pending', attempts = 0, available_at = ?, updated_at = ?
+          WHERE state = 'failed'
+        """, (now, now))
+        return cur.rowcount
+
+
+def mark_messages_processed(job: Dict[str, Any]) -> int:
+    """Помечает сообщения окна job'а обработанными (для ретенции); вызывается в транзакции коммита job'а."""
+    with transaction() as conn:
+        cur = conn.execute("""
+          UPDATE messages SET processed_job_id = ?
+          WHERE chat_id = ? AND created_at >= ? AND id > ? AND id <= ?
+        """, (job["id"], job["chat_id"], job["window_start"], job["after_message_id"], job["max_message_id"]))
+        return cur.rowcount
+
+
+def load_job_messages(job: Dict[str, Any]) -> list:
+    return get_conn().execute("""
+      SELECT user_name, user_id, text, created_at
+      FROM messages
+      WHERE chat_id = ? AND created_at >= ? AND id > ? AND id <= ?
+      ORDER BY created_at ASC, id ASC
+    """, (job["chat_id"], job["window_start"], job["after_message_id"], job["max_message_id"])).fetchall()
+
+
+def job_stats() -> Dict[str, int]:
+    rows = get_conn().execute("SELECT state, COUNT(*) AS n FROM batch_jobs GROUP BY state").fetchall()
+    return {r["state"]: r["n"] for r in rows}
+
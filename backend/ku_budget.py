@@ -0,0 +1,125 @@
+import json
+import sqlite3
+import zlib
+from typing import Any, Dict, List, Tuple
+
+from backend.db import get_conn
+from config import settings
+
+
+HISTORY_CODEC = "zlib-json"
+
+# Списки content_ai, которые модель ведёт сама (старые пункты — в начале)
+_LIST_FIELDS = ("decisions", "open_questions", "next_steps")
+
+
+# -------------------------
+# Бюджеты полей KUContent
+# -------------------------
+def _clip(text: str, max_chars: int) -> str:
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 1)].rstrip() + "…"
+
+
+def apply_budget(content: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Dict[str, str]]]:
+    """
+    Приводит content_ai к бюджетам ku_*: обрезает summary и пункты списков,
+    оставляет последние ku_list_max_items пунктов и свежие заметки в пределах
+    ku_notes_max_items / ku_notes_max_chars. Всё вытесненное (в полном виде)
+    возвращается вторым элементом как [{"field", "text"}] — для ku_history.
+    """
+    if not settings.ku_budget_enabled:
+        return content, []
+
+    out = dict(content)
+    rolled: List[Dict[str, str]] = []
+
+    summary = out.get("summary") or ""
+    if len(summary) > settings.ku_summary_max_chars:
+        rolled.append({"field": "summary", "text": summary})
+        out["summary"] = _clip(summary, settings.ku_summary_max_chars)
+
+    for field in _LIST_FIELDS:
+        items = [str(x) for x in (out.get(field) or [])]
+        limit = settings.ku_list_max_items
+        if limit and len(items) > limit:
+            rolled += [{"field": field, "text": x} for x in items[:-limit]]
+            items = items[-limit:]
+        clipped = []
+        for x in items:
+            if len(x) > settings.ku_item_max_chars:
+                rolled.append({"field": field, "text": x})
+            clipped.append(_clip(x, settings.ku_item_max_chars))
+        out[field] = clipped
+
+    # заметки: точные повторы схлопываем (остаётся последний), дальше — с конца, пока влезает
+    notes = list(dict.fromkeys(reversed([str(x) for x in (out.get("notes") or [])])))
+    kept: List[str] = []
+    chars = 0
+    for i, note in enumerate(notes):
+        short = _clip(note, settings.ku_item_max_chars)
+        if len(kept) >= settings.ku_notes_max_items or (kept and chars + len(short) > settings.ku_notes_max_chars):
+            rolled += [{"field": "notes", "text": x} for x in reversed(notes[i:])]
+            break
+        if short != note:
+            rolled.append({"field": "notes", "text": note})
+        kept.append(short)
+        chars += len(short)
+    out["notes"] = list(reversed(kept))
+
+    return out, rolled
+
+
+# -------------------------
+# ku_history: вытесненное хранится отдельно, в LLM не уходит
+# -------------------------
+def _pack(entries: List[Dict[str, str]]) -> bytes:
+    raw = json.dumps(entries, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(raw, 6)
+
+
+def _unpack(codec: str, payload: bytes) -> List[Dict[str, str]]:
+    if codec != HISTORY_CODEC:
+        raise ValueError(f"unknown history codec: {codec}")
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def write_history(conn: sqlite3.Connection, ku_id: str, entries: List[Dict[str, str]], ts: int) -> None:
+    """Одна строка на коммит KU; вызывается внутри транзакции коммита."""
+    if not entries:
+        return
+    conn.execute("""
+      INSERT INTO ku_history (ku_id, rolled_at, item_count, codec, payload)
+      VALUES (?, ?, ?, ?, ?)
+    """, (ku_id, ts, len(entries), HISTORY_CODEC, _pack(entries)))
+
+
+def load_ku_history(ku_id: str, limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+    """Свёрнутая история KU, новые свёртки первыми."""
+    conn = get_conn()
+    total = conn.execute(
+        "SELECT COUNT(*) AS n, COALESCE(SUM(item_count), 0) AS items FROM ku_history WHERE ku_id = ?", (ku_id,)
+    ).fetchone()
+    rows = conn.execute("""
+      SELECT id, rolled_at, codec, payload FROM ku_history
+      WHERE ku_id = ?
+      ORDER BY id DESC
+      LIMIT ? OFFSET ?
+    """, (ku_id, limit, offset)).fetchall()
+    return {
+        "ku_id": ku_id,
+        "rollups": total["n"],
+        "items": total["items"],
+        "history": [
+            {"id": r["id"], "rolled_at": r["rolled_at"], "entries": _unpack(r["codec"], r["payload"])}
+            for r in rows
+        ],
+    }
+
+
+def history_size(ku_id: str) -> int:
+    row = get_conn().execute(
+        "SELECT COALESCE(SUM(item_count), 0) AS n FROM ku_history WHERE ku_id = ?", (ku_id,)
+    ).fetchone()
+    return row["n"]
@@ -0,0 +1,213 @@
+import json
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+import numpy as np
+
+from backend.db import get_conn
+from config import settings
+
+
+# -------------------------
+# Embedders
+# -------------------------
+class Embedder(Protocol):
+    dim: int
+
+    def embed(self, text: str) -> np.ndarray:
+        ...
+
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """
+    Локальный эмбеддер без модели: слова + символьные n-граммы слов,
+    захешированные (crc32 — стабилен между процессами) в dim корзин.
+    Возвращает сублинейные TF-веса; IDF и нормировку делает индекс.
+    """
+
+    def __init__(self, dim: int = 4096, ngram_range: Tuple[int, int] = (3, 4)):
+        self.dim = dim
+        self._ngram_range = ngram_range
+
+    def _features(self, text: str) -> List[str]:
+        words = _TOKEN_RE.findall((text or "").lower().replace("ё", "е"))
+        feats = []
+        lo, hi = self._ngram_range
+        for w in words:
+            feats.append("w:" + w)
+            padded = f"<{w}>"
+            for n in range(lo, hi + 1):
+                for i in range(len(padded) - n + 1):
+                    feats.append(padded[i:i + n])
+        return feats
+
+    def embed(self, text: str) -> np.ndarray:
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for f in self._features(text):
+            vec[zlib.crc32(f.encode("utf-8")) % self.dim] += 1.0
+        np.log1p(vec, out=vec)
+        return vec
+
+
+# -------------------------
+# Index
+# -------------------------
+class KUIndex:
+    """
+    Векторный индекс KU одного проекта (TF-IDF косинус по векторам эмбеддера).
+    Держит матрицу TF и document frequency; обновляется инкрементально
+    через upsert/remove. Метаданные (title/type/status) хранятся рядом,
+    чтобы отдавать кандидатов в decide_ku_action без похода в БД.
+    """
+
+    def __init__(self, embedder: Optional[Embedder] = None):
+        self._embedder = embedder or HashingEmbedder()
+        self._lock = threading.Lock()
+        self._ids: List[str] = []
+        self._pos: Dict[str, int] = {}
+        self._meta: List[Dict[str, Any]] = []
+        # TF-матрица с запасом по ёмкости: строки [0, len) заняты
+        self._tf = np.zeros((16, self._embedder.dim), dtype=np.float32)
+        self._df = np.zeros(self._embedder.dim, dtype=np.float32)
+        self._weighted: Optional[np.ndarray] = None
+        self._idf: Optional[np.ndarray] = None
+        self.built_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def upsert(self, ku_id: str, text: str, meta: Dict[str, Any]) -> None:
+        vec = self._embedder.embed(text)
+        with self._lock:
+            pos = self._pos.get(ku_id)
+            if pos is None:
+                pos = len(self._ids)
+                if pos == self._tf.shape[0]:
+                    grown = np.zeros((pos * 2, self._tf.shape[1]), dtype=np.float32)
+                    grown[:pos] = self._tf
+                    self._tf = grown
+                self._pos[ku_id] = pos
+                self._ids.append(ku_id)
+                self._meta.append(dict(meta))
+                self._tf[pos] = vec
+            else:
+                self._df -= (self._tf[pos] > 0)
+                self._tf[pos] = vec
+                self._meta[pos] = dict(meta)
+            self._df += (vec > 0)
+            self._weighted = None
+
+    def remove(self, ku_id: str) -> None:
+        with self._lock:
+            pos = self._pos.pop(ku_id, None)
+            if pos is None:
+                return
+            self._df -= (self._tf[pos] > 0)
+            # на место удалённой строки переносим последнюю
+            last = len(self._ids) - 1
+            if pos != last:
+                self._tf[pos] = self._tf[last]
+                self._ids[pos] = self._ids[last]
+                self._meta[pos] = self._meta[last]
+                self._pos[self._ids[pos]] = pos
+            self._tf[last] = 0
+            self._ids.pop()
+            self._meta.pop()
+            self._weighted = None
+
+    def _ensure_weighted(self) -> None:
+        if self._weighted is not None:
+            return
+        n = len(self._ids)
+        self._idf = (np.log((1.0 + n) / (1.0 + self._df)) + 1.0).astype(np.float32)
+        w = self._tf[:n] * self._idf
+        norms = np.linalg.norm(w, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self._weighted = w / norms
+
+    def search(self, text: str, k: int) -> List[Tuple[Dict[str, Any], float]]:
+        """Top-k KU по косинусной близости: [(meta, score)], score по убыванию."""
+        q = self._embedder.embed(text)
+        with self._lock:
+            if not self._ids:
+                return []
+            self._ensure_weighted()
+            q = q * self._idf
+            norm = float(np.linalg.norm(q))
+            if norm == 0:
+                return []
+            scores = self._weighted @ (q / norm)
+
+            k = min(k, len(self._ids))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(dict(self._meta[i]), float(scores[i])) for i in top]
+
+
+def ku_index_text(title: str, content_ai: Dict[str, Any]) -> str:
+    return f"{title}\n{(content_ai or {}).get('summary', '')}"
+
+
+# -------------------------
+# Per-project registry
+# -------------------------
+_indexes: Dict[str, KUIndex] = {}
+_registry_lock = threading.Lock()
+
+
+def _build_index(project_id: str) -> KUIndex:
+    index = KUIndex()
+    rows = get_conn().execute("""
+      SELECT id, title, type, status, content_ai_json
+      FROM kus
+      WHERE project_id = ? AND status = 'Active'
+    """, (project_id,)).fetchall()
+    for r in rows:
+        index.upsert(
+            r["id"],
+            ku_index_text(r["title"], json.loads(r["content_ai_json"])),
+            {"id": r["id"], "title": r["title"], "type": r["type"], "status": r["status"]},
+        )
+    return index
+
+
+def get_ku_index(project_id: str) -> KUIndex:
+    """
+    Индекс проекта; строится из БД при первом обращении и перестраивается
+    раз в ku_index_rebuild_seconds — чтобы подхватить KU, созданные другими процессами.
+    """
+    with _registry_lock:
+        index = _indexes.get(project_id)
+    if index is not None and time.time() - index.built_at < settings.ku_index_rebuild_seconds:
+        return index
+
+    index = _build_index(project_id)
+    with _registry_lock:
+        _indexes[project_id] = index
+    return index
+
+
+def index_ku(project_id: Optional[str], ku_id: str, title: str, ku_type: str, status: str,
+             content_ai: Dict[str, Any]) -> None:
+    """Инкрементальное обновление индекса после создания/обновления KU."""
+    if not settings.ku_index_enabled:
+        return
+    with _registry_lock:
+        index = _indexes.get(project_id or "")
+    if index is None:
+        # индекс ещё не строился — соберётся из БД при первом поиске
+        return
+    if status != "Active":
+        index.remove(ku_id)
+        return
+    index.upsert(
+        ku_id,
+        ku_index_text(title, content_ai),
+        {"id": ku_id, "title": title, "type": ku_type, "status": status},
+    )
@@ -0,0 +1,153 @@
+import json
+import sqlite3
+import zlib
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, Optional
+
+from backend.db import get_conn
+from config import settings
+
+
+REVISION_CODEC = "zlib-json"
+
+
+# -------------------------
+# Дельты content_ai
+# -------------------------
+# Дельта — {поле: операция}, только по изменённым полям:
+#   {"set": value}          — скаляр (summary) или поле целиком
+#   {"ops": [[i1, i2, [...]], ...]} — правки списка: old[i1:i2] заменить на [...]
+#   {"del": true}           — поле удалено
+def diff_content(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    delta: Dict[str, Any] = {}
+    for field in dict.fromkeys([*old, *new]):
+        if field not in new:
+            delta[field] = {"del": True}
+            continue
+        a, b = old.get(field), new[field]
+        if a == b:
+            continue
+        if isinstance(a, list) and isinstance(b, list):
+            sm = SequenceMatcher(None, a, b, autojunk=False)
+            delta[field] = {"ops": [[i1, i2, b[j1:j2]] for tag, i1, i2, j1, j2 in sm.get_opcodes() if tag != "equal"]}
+        else:
+            delta[field] = {"set": b}
+    return delta
+
+
+def apply_delta(content: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(content)
+    for field, op in delta.items():
+        if op.get("del"):
+            out.pop(field, None)
+        elif "set" in op:
+            out[field] = op["set"]
+        else:
+            items = list(out.get(field) or [])
+            # с конца, чтобы индексы ещё не применённых правок не съезжали
+            for i1, i2, repl in reversed(op["ops"]):
+                items[i1:i2] = repl
+            out[field] = items
+    return out
+
+
+def _pack(data: Any) -> bytes:
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def _unpack(codec: str, payload: bytes) -> Any:
+    if codec != REVISION_CODEC:
+        raise ValueError(f"unknown revision codec: {codec}")
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+# -------------------------
+# Запись: вызывается из KUUnitOfWork.commit внутри его транзакции
+# -------------------------
+def _insert(conn: sqlite3.Connection, ku_id: str, version: int, kind: str, data: Any,
+            job_id: Optional[int], topics: List[str], ts: int) -> None:
+    conn.execute("""
+      INSERT OR REPLACE INTO ku_revisions (ku_id, version, kind, job_id, topics_json, codec, payload, created_at)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (ku_id, version, kind, job_id, json.dumps(topics, ensure_ascii=False), REVISION_CODEC, _pack(data), ts))
+
+
+def write_revision(conn: sqlite3.Connection, ku_id: str, version: int,
+                   old: Optional[Dict[str, Any]], new: Dict[str, Any],
+                   job_id: Optional[int], topics: List[str], ts: int) -> None:
+    """
+    Ревизия version: дельта от old (состояние version - 1), а каждая
+    ku_revision_snapshot_every-я — полный снимок, чтобы восстановление
+    не проходило длинную цепочку. Если у KU ещё нет ревизии version - 1
+    (KU старше этой таблицы), сначала сохраняется снимок old.
+    """
+    if not settings.ku_revisions_enabled:
+        return
+
+    if old is not None and version > 1:
+        prev = conn.execute(
+            "SELECT 1 FROM ku_revisions WHERE ku_id = ? AND version = ?", (ku_id, version - 1)
+        ).fetchone()
+        if prev is None:
+            _insert(conn, ku_id, version - 1, "snapshot", old, None, [], ts)
+
+    every = max(1, settings.ku_revision_snapshot_every)
+    if old is None or (version - 1) % every == 0:
+        _insert(conn, ku_id, version, "snapshot", new, job_id, topics, ts)
+    else:
+        _insert(conn, ku_id, version, "delta", diff_content(old, new), job_id, topics, ts)
+
+
+# -------------------------
+# Чтение
+# -------------------------
+def list_revisions(ku_id: str, limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+    """Метаданные ревизий KU, новые первыми (без восстановления контента)."""
+    rows = get_conn().execute("""
+      SELECT version, kind, job_id, topics_json, created_at, LENGTH(payload) AS bytes
+      FROM ku_revisions
+      WHERE ku_id = ?
+      ORDER BY version DESC
+      LIMIT ? OFFSET ?
+    """, (ku_id, limit, offset)).fetchall()
+    return {
+        "ku_id": ku_id,
+        "revisions": [
+            {"version": r["version"], "kind": r["kind"], "job_id": r["job_id"],
+             "topics": json.loads(r["topics_json"]), "created_at": r["created_at"], "bytes": r["bytes"]}
+            for r in rows
+        ],
+    }
+
+
+def reconstruct(ku_id: str, version: int) -> Optional[Dict[str, Any]]:
+    """
+    content_ai KU на момент ревизии version: ближайший снимок не позже неё
+    плюс дельты после него (не больше ku_revision_snapshot_every строк).
+    None — такой ревизии нет.
+    """
+    rows = get_conn().execute("""
+      SELECT version, kind, job_id, topics_json, created_at, codec, payload
+      FROM ku_revisions
+      WHERE ku_id = ? AND version <= ? AND version >= (
+        SELECT MAX(version) FROM ku_revisions WHERE ku_id = ? AND version <= ? AND kind = 'snapshot'
+      )
+      ORDER BY version
+    """, (ku_id, version, ku_id, version)).fetchall()
+    if not rows or rows[-1]["version"] != version:
+        return None
+
+    content: Dict[str, Any] = {}
+    for r in rows:
+        data = _unpack(r["codec"], r["payload"])
+        content = data if r["kind"] == "snapshot" else apply_delta(content, data)
+
+    last = rows[-1]
+    return {
+        "ku_id": ku_id,
+        "version": version,
+        "job_id": last["job_id"],
+        "topics": json.loads(last["topics_json"]),
+        "created_at": last["created_at"],
+        "content_ai": content,
+    }
@@ -0,0 +1,41 @@
+import time
+from typing import Any, Dict, Optional
+
+from backend.db import get_conn, transaction
+from backend.jobs import WORKER_ID
+
+
+# -------------------------
+# Именованные lease'ы в SQLite: кто из процессов сейчас отвечает за общую работу
+# -------------------------
+def acquire_lease(name: str, ttl_seconds: float, owner: str = WORKER_ID) -> bool:
+    """
+    Берёт или продлевает lease. Условный UPSERT: строка перезаписывается,
+    только если lease уже наш или истёк — так что держатель всегда один.
+    """
+    now = time.time()
+    with transaction() as conn:
+        cur = conn.execute("""
+          INSERT INTO leases (name, owner, expires_at, acquired_at)
+          VALUES (?, ?, ?, ?)
+          ON CONFLICT(name) DO UPDATE SET
+            owner = excluded.owner,
+            expires_at = excluded.expires_at,
+            acquired_at = CASE WHEN leases.owner = excluded.owner THEN leases.acquired_at
+                               ELSE excluded.acquired_at END
+          WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        """, (name, owner, now + ttl_seconds, now, now))
+        return cur.rowcount == 1
+
+
+def release_lease(name: str, owner: str = WORKER_ID) -> bool:
+    with transaction() as conn:
+        cur = conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+        return cur.rowcount == 1
+
+
+def lease_holder(name: str) -> Optional[Dict[str, Any]]:
+    row = get_conn().execute(
+        "SELECT * FROM leases WHERE name = ? AND expires_at >= ?", (name, time.time())
+    ).fetchone()
+    return dict(row) if row is not None else None
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from backend.db import get_conn, transaction
+from config import settings
+
+
+class LLMCache:
+    """
+    Content-addressed кэш ответов LLM.
+    Ключ — sha256 от (model, system, prompt, temperature, schema).
+    Два уровня: LRU в памяти процесса и таблица llm_cache в SQLite
+    (переживает рестарт и общая для всех процессов), с TTL и лимитом строк.
+    Значения хранятся как JSON-строки — вызывающий всегда получает свою копию.
+    """
+
+    # раз в столько записей чистим устаревшее/лишнее в SQLite
+    EVICT_EVERY = 100
+
+    def __init__(self, memory_entries: int, ttl_seconds: int, max_rows: int):
+        self._memory_entries = memory_entries
+        self._ttl = ttl_seconds
+        self._max_rows = max_rows
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts_since_evict = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model: str, system: str, prompt: str, temperature: float, schema: str) -> str:
+        raw = json.dumps([model, system, prompt, float(temperature), schema], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def enabled_for(self, temperature: float) -> bool:
+        if not settings.llm_cache_enabled:
+            return False
+        # при temperature > 0 ответ недетерминирован — по умолчанию не кэшируем
+        return temperature <= 0 or settings.llm_cache_nondeterministic
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                created_at, value = item
+                if now - created_at < self._ttl:
+                    self._mem.move_to_end(key)
+                    self.memory_hits += 1
+                    return json.loads(value)
+                del self._mem[key]
+
+        row = get_conn().execute(
+            "SELECT value_json, created_at FROM llm_cache WHERE key = ? AND created_at >= ?",
+            (key, int(now - self._ttl))
+        ).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with transaction() as conn:
+            conn.execute("UPDATE llm_cache SET last_hit_at = ? WHERE key = ?", (int(now), key))
+
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, row["created_at"], row["value_json"])
+        return json.loads(row["value_json"])
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        now = int(time.time())
+        value_json = json.dumps(value, ensure_ascii=False)
+
+        with transaction() as conn:
+            conn.execute("""
+              INSERT OR REPLACE INTO llm_cache (key, value_json, created_at, last_hit_at)
+              VALUES (?, ?, ?, ?)
+            """, (key, value_json, now, now))
+
+        with self._lock:
+            self.stores += 1
+            self._remember(key, now, value_json)
+            self._puts_since_evict += 1
+            evict = self._puts_since_evict >= self.EVICT_EVERY
+            if evict:
+                self._puts_since_evict = 0
+
+        if evict:
+            self.evict()
+
+    def _remember(self, key: str, created_at: float, value_json: str) -> None:
+        self._mem[key] = (created_at, value_json)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self._memory_entries:
+            self._mem.popitem(last=False)
+
+    def evict(self) -> int:
+        """Удаляет из SQLite устаревшие по TTL и самые давно использованные сверх max_rows."""
+        now = int(time.time())
+        with transaction() as conn:
+            removed = conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (now - self._ttl,)
+            ).rowcount
+
+            total = conn.execute("SELECT COUNT(*) AS n FROM llm_cache").fetchone()["n"]
+            if total > self._max_rows:
+                removed += conn.execute("""
+                  DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY last_hit_at ASC LIMIT ?
+                  )
+                """, (total - self._max_rows,)).rowcount
+
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "enabled": settings.llm_cache_enabled,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 3) if total else None,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "memory_entries": len(self._mem),
+            }
+
+
+llm_cache = LLMCache(
+    memory_entries=settings.llm_cache_memory_entries,
+    ttl_seconds=settings.llm_cache_ttl_seconds,
+    max_rows=settings.llm_cache_max_rows,
+)
@@ -1,7 +1,13 @@
+import asyncio
 import json
+import random
+import threading
+import time
 import httpx
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 from config import settings
+from backend.db import run_db
+from backend.llm_cache import llm_cache
 
 PROXYAPI_URL = "https://api.proxyapi.ru/openai/v1/chat/completions"
 OPENAI_URL = "https://api.openai.com/v1/chat/completions"
@@ -29,6 +35,11 @@ def _headers() -> Dict[str, str]:
     raise RuntimeError("LLM_PROVIDER должен быть proxyapi или openai")
 
 
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка токенов без токенайзера: для кириллицы ~3 символа на токен."""
+    return len(text or "") // 3 + 1
+
+
 def _strip_code_fence(s: str) -> str:
     s = (s or "").strip()
     if s.startswith("```"):
@@ -37,7 +48,235 @@ def _strip_code_fence(s: str) -> str:
     return s.strip()
 
 
-def chat_json(system: str, user: str, schema_hint: str, temperature: float = 0.0) -> Dict[str, Any]:
+# -------------------------
+# Request governor: rate limit + retry + circuit breaker
+# -------------------------
+class LLMUnavailableError(RuntimeError):
+    """Провайдер недоступен (circuit breaker открыт или ретраи исчерпаны)."""
+
+
+class TokenBucket:
+    """
+    Token bucket с резервированием: reserve() сразу списывает amount (баланс может
+    уйти в минус) и говорит, сколько секунд подождать (ждёт вызывающий — asyncio.sleep).
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self._rate = per_minute / 60.0
+        self._capacity = capacity if capacity is not None else per_minute
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        if self._rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            # запрос больше ёмкости не должен ждать вечно
+            self._tokens -= min(amount, self._capacity)
+            return 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+
+
+class CircuitBreaker:
+    """
+    closed → (failure_threshold ошибок подряд) → open → (reset_seconds) → half_open:
+    пропускается один пробный запрос; успех закрывает, ошибка снова открывает.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self._threshold = failure_threshold
+        self._reset = reset_seconds
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self._reset:
+                return "half_open"
+            return "open"
+
+    def remaining_seconds(self) -> float:
+        """Сколько ещё breaker будет open (без побочных эффектов, в отличие от wait_seconds)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self._reset - time.monotonic())
+
+    def wait_seconds(self) -> float:
+        """0 — можно слать запрос сейчас (и, если half_open, он становится пробным)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            left = self._opened_at + self._reset - time.monotonic()
+            if left > 0:
+                return left
+            if self._probe_in_flight:
+                return 1.0
+            self._probe_in_flight = True
+            return 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or self._failures >= self._threshold:
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+# дефолтные лимиты провайдеров (запросов / токенов в минуту); переопределяются в .env
+_PROVIDER_LIMITS = {
+    "proxyapi": (60, 60_000),
+    "openai": (500, 200_000),
+}
+
+_RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RequestGovernor:
+    """
+    Всё, что между нами и провайдером: лимиты RPM/TPM (по оценке токенов),
+    ретраи с экспоненциальной задержкой и jitter (Retry-After уважается)
+    и circuit breaker, который «паркует» запросы, пока провайдер лежит.
+    """
+
+    def __init__(self, provider: str):
+        rpm, tpm = _PROVIDER_LIMITS.get(provider, _PROVIDER_LIMITS["proxyapi"])
+        self.provider = provider
+        self.requests = TokenBucket(settings.llm_requests_per_minute or rpm)
+        self.tokens = TokenBucket(settings.llm_tokens_per_minute or tpm)
+        self.breaker = CircuitBreaker(settings.llm_breaker_failures, settings.llm_breaker_reset_seconds)
+        self.retries = 0
+        self.failures = 0
+
+    def _park_seconds(self, parked: float) -> float:
+        wait = self.breaker.wait_seconds()
+        if wait > 0 and parked + wait > settings.llm_breaker_max_park_seconds:
+            raise LLMUnavailableError(f"{self.provider}: circuit breaker open")
+        return wait
+
+    def _limit_seconds(self, payload: Dict[str, Any]) -> float:
+        est = sum(estimate_tokens(m["content"]) for m in payload["messages"]) + settings.llm_expected_output_tokens
+        return max(self.requests.reserve(1), self.tokens.reserve(est))
+
+    @staticmethod
+    def _backoff(attempt: int, resp: Optional[httpx.Response]) -> float:
+        if resp is not None:
+            retry_after = resp.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), settings.llm_retry_max_delay)
+                except ValueError:
+                    pass
+        delay = min(settings.llm_retry_base_delay * (2 ** attempt), settings.llm_retry_max_delay)
+        return random.uniform(delay / 2, delay)  # jitter
+
+    def _outcome(self, resp: Optional[httpx.Response], error: Optional[Exception]) -> bool:
+        """True — ответ успешный/окончательный; False — стоит повторить."""
+        if error is None and resp.status_code not in _RETRY_STATUSES:
+            if resp.status_code < 500:
+                self.breaker.record_success()
+            return True
+        self.failures += 1
+        self.breaker.record_failure()
+        return False
+
+    def _give_up(self, resp: Optional[httpx.Response], error: Optional[Exception]) -> None:
+        # сюда попадаем только с ретраебельной ошибкой (сеть / 429 / 5xx) — провайдер недоступен
+        if error is not None:
+            raise LLMUnavailableError(f"{self.provider}: {error}") from error
+        raise LLMUnavailableError(f"{self.provider}: HTTP {resp.status_code} after retries")
+
+    def retry_after_seconds(self) -> float:
+        """Когда имеет смысл снова идти к провайдеру: после сброса breaker'а."""
+        remaining = self.breaker.remaining_seconds()
+        return remaining + 1 if remaining > 0 else settings.llm_breaker_reset_seconds
+
+    async def asend(self, client: httpx.AsyncClient, url: str, headers: Dict[str, str],
+                    payload: Dict[str, Any]) -> httpx.Response:
+        parked = 0.0
+        for attempt in range(settings.llm_max_retries + 1):
+            while (wait := self._park_seconds(parked)) > 0:
+                await asyncio.sleep(wait)
+                parked += wait
+            await asyncio.sleep(self._limit_seconds(payload))
+
+            resp, error = None, None
+            try:
+                resp = await client.post(url, headers=headers, json=payload)
+            except httpx.TransportError as e:
+                error = e
+            if self._outcome(resp, error):
+                resp.raise_for_status()
+                return resp
+            if attempt == settings.llm_max_retries:
+                self._give_up(resp, error)
+            self.retries += 1
+            await asyncio.sleep(self._backoff(attempt, resp))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "provider": self.provider,
+            "breaker": self.breaker.state,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+
+_governors: Dict[str, RequestGovernor] = {}
+
+
+def get_governor() -> RequestGovernor:
+    provider = (settings.llm_provider or "").lower()
+    gov = _governors.get(provider)
+    if gov is None:
+        gov = _governors.setdefault(provider, RequestGovernor(provider))
+    return gov
+
+
+# -------------------------
+# HTTP-клиенты (общие, с keep-alive)
+# -------------------------
+_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+
+_async_client: Optional[httpx.AsyncClient] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_async_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    # AsyncClient привязан к event loop'у, в котором открыт пул соединений
+    global _async_client, _async_client_loop, _async_semaphore
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(timeout=60, limits=_LIMITS)
+        _async_client_loop = loop
+        # общий лимит одновременных запросов к провайдеру на процесс
+        _async_semaphore = asyncio.Semaphore(max(1, settings.llm_max_concurrency))
+    return _async_client
+
+
+async def aclose_llm_client() -> None:
+    global _async_client
+    if _async_client is not None and _async_client_loop is asyncio.get_running_loop():
+        await _async_client.aclose()
+    _async_client = None
+
+
+def _build_payload(system: str, user: str, schema_hint: str, temperature: float) -> Dict[str, Any]:
     prompt = (
         f"{user}\n\n"
         f"Верни ОДИН JSON-объект строго по схеме:\n{schema_hint}\n"
@@ -47,7 +286,7 @@ def chat_json(system: str, user: str, schema_hint: str, temperature: float = 0.0
         f"- Никаких лишних ключей\n"
     )
 
-    payload = {
+    return {
         "model": settings.llm_model,
         "messages": [
             {"role": "system", "content": system},
@@ -56,11 +295,8 @@ def chat_json(system: str, user: str, schema_hint: str, temperature: float = 0.0
         "temperature": temperature,
     }
 
-    with httpx.Client(timeout=60) as client:
-        resp = client.post(_base_url(), headers=_headers(), json=payload)
-        resp.raise_for_status()
-        data = resp.json()
 
+def _parse_response(data: Dict[str, Any]) -> Dict[str, Any]:
     raw = _strip_code_fence(data["choices"][0]["message"]["content"])
 
     try:
@@ -69,10 +305,42 @@ def chat_json(system: str, user: str, schema_hint: str, temperature: float = 0.0
         return {"_error": f"json_parse_failed: {e}", "raw": raw}
 
 
+def _cache_key(payload: Dict[str, Any], schema_hint: str) -> Optional[str]:
+    temperature = payload["temperature"]
+    if not llm_cache.enabled_for(temperature):
+        return None
+    system, prompt = (m["content"] for m in payload["messages"])
+    return llm_cache.make_key(payload["model"], system, prompt, temperature, schema_hint)
+
+
+def _cache_store(key: Optional[str], result: Dict[str, Any]) -> None:
+    # ошибки парсинга не кэшируем — следующая попытка может пройти
+    if key is not None and "_error" not in result:
+        llm_cache.put(key, result)
+
+
+async def achat_json(system: str, user: str, schema_hint: str, temperature: float = 0.0) -> Dict[str, Any]:
+    """Один JSON-запрос к модели (с кэшем): не блокирует event loop, пока модель думает."""
+    payload = _build_payload(system, user, schema_hint, temperature)
+
+    key = _cache_key(payload, schema_hint)
+    if key is not None:
+        cached = await run_db(llm_cache.get, key)
+        if cached is not None:
+            return cached
+
+    client = _get_async_client()
+    async with _async_semaphore:
+        resp = await get_governor().asend(client, _base_url(), _headers(), payload)
+    result = _parse_response(resp.json())
+    await run_db(_cache_store, key, result)
+    return result
+
+
 # -------------------------
 # 1) AI-фильтр + темы (topics)
 # -------------------------
-def select_relevant(batch_text: str) -> Dict[str, Any]:
+def _select_relevant_request(batch_text: str) -> Dict[str, Any]:
     schema = """{
       "topics": [
         {
@@ -111,7 +379,7 @@ def select_relevant(batch_text: str) -> Dict[str, Any]:
 Батч:
 {batch_text}
 """
-    return chat_json(
+    return dict(
         system="Ты чистишь чат от мусора и группируешь по темам для базы знаний.",
         user=user,
         schema_hint=schema,
@@ -119,10 +387,14 @@ def select_relevant(batch_text: str) -> Dict[str, Any]:
     )
 
 
+async def aselect_relevant(batch_text: str) -> Dict[str, Any]:
+    return await achat_json(**_select_relevant_request(batch_text))
+
+
 # -------------------------
 # 2) Решить: обновить существующий KU или создать новый
 # -------------------------
-def decide_ku_action(batch_text: str, active_kus: list) -> Dict[str, Any]:
+def _decide_ku_action_request(batch_text: str, active_kus: list) -> Dict[str, Any]:
     schema = """{
       "action": "update_ku" | "create_ku" | "noop",
       "target_ku_id": string | null,
@@ -149,7 +421,7 @@ def decide_ku_action(batch_text: str, active_kus: list) -> Dict[str, Any]:
 - update_ku нельзя возвращать без target_ku_id
 """
 
-    return chat_json(
+    return dict(
         system="Ты маршрутизируешь темы чата в KU: обновить существующий или создать новый.",
         user=user,
         schema_hint=schema,
@@ -157,27 +429,14 @@ def decide_ku_action(batch_text: str, active_kus: list) -> Dict[str, Any]:
     )
 
 
+async def adecide_ku_action(batch_text: str, active_kus: list) -> Dict[str, Any]:
+    return await achat_json(**_decide_ku_action_request(batch_text, active_kus))
+
+
 # -------------------------
 # 3) Обновить KU контент, учитывая переносы/конфликты
 # -------------------------
-def update_ku_content(existing_content: Dict[str, Any], batch_text: str) -> Dict[str, Any]:
-    schema = """{
-      "summary": string,
-      "decisions": [string],
-      "open_questions": [string],
-      "next_steps": [string],
-      "notes": [string]
-    }"""
-
-    user = f"""Текущий AI-контент KU (JSON):
-{json.dumps(existing_content, ensure_ascii=False)}
-
-Новые сообщения по этой теме:
-{batch_text}
-
-Твоя задача — обновить KU.
-
-Правила извлечения:
+_KU_CONTENT_RULES = """Правила извлечения:
 1) DECISIONS:
 - Считай решениями не только фразы со словом "решили",
   но и любые ДОГОВОРЁННОСТИ и распоряжения:
@@ -207,13 +466,99 @@ def update_ku_content(existing_content: Dict[str, Any], batch_text: str) -> Dict
 6) ЧИСТОТА:
 - Не добавляй мат/оскорбления
 - Не добавляй мусорные строки
+"""
+
 
+def _update_ku_content_request(existing_content: Dict[str, Any], batch_text: str) -> Dict[str, Any]:
+    schema = """{
+      "summary": string,
+      "decisions": [string],
+      "open_questions": [string],
+      "next_steps": [string],
+      "notes": [string]
+    }"""
+
+    user = f"""Текущий AI-контент KU (JSON):
+{json.dumps(existing_content, ensure_ascii=False)}
+
+Новые сообщения по этой теме:
+{batch_text}
+
+Твоя задача — обновить KU.
+
+{_KU_CONTENT_RULES}
 Верни JSON строго по схеме.
 """
 
-    return chat_json(
+    return dict(
         system="Ты ведёшь KU как живой документ: фиксируешь решения, вопросы, действия и историю переносов.",
         user=user,
         schema_hint=schema,
         temperature=0.2,
     )
+
+
+async def aupdate_ku_content(existing_content: Dict[str, Any], batch_text: str) -> Dict[str, Any]:
+    return await achat_json(**_update_ku_content_request(existing_content, batch_text))
+
+
+# -------------------------
+# 2+3) Одним вызовом: маршрутизация + обновлённый контент KU
+# -------------------------
+def _route_and_update_request(batch_text: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    schema = """{
+      "action": "update_ku" | "create_ku" | "noop",
+      "target_ku_id": string | null,
+      "new_ku": { "title": string, "type": "Discussion"|"Decision"|"Hypothesis"|"Note" } | null,
+      "content": {
+        "summary": string,
+        "decisions": [string],
+        "open_questions": [string],
+        "next_steps": [string],
+        "notes": [string]
+      } | null,
+      "reason": string
+    }"""
+
+    blocks = []
+    for k in candidates:
+        line = f"- {k['id']} | {k['title']} | {k['type']} | {k['status']}"
+        if k.get("content_ai") is not None:
+            line += f"\n  Текущий AI-контент (JSON): {json.dumps(k['content_ai'], ensure_ascii=False)}"
+        blocks.append(line)
+    kus_lines = "\n".join(blocks) or "(пусто)"
+
+    user = f"""Текст (уже очищенный, одна тема):
+{batch_text}
+
+Активные KU (кандидаты):
+{kus_lines}
+
+Шаг 1 — выбор:
+- update_ku: если тема явно продолжает существующий KU
+- create_ku: если тема новая
+- noop: если нет полезной информации
+
+Шаг 2 — контент:
+- update_ku: content = обновлённый AI-контент выбранного KU (на основе его текущего контента + новых сообщений)
+- create_ku: content = AI-контент нового KU только по новым сообщениям
+- noop: content = null
+
+Важно:
+- update_ku нельзя возвращать без target_ku_id
+- если у выбранного KU нет текущего контента в списке — верни content = null
+
+{_KU_CONTENT_RULES}
+Верни JSON строго по схеме.
+"""
+
+    return dict(
+        system="Ты маршрутизируешь темы чата в KU и сразу ведёшь выбранный KU как живой документ.",
+        user=user,
+        schema_hint=schema,
+        temperature=0.2,
+    )
+
+
+async def aroute_and_update(batch_text: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return await achat_json(**_route_and_update_request(batch_text, candidates))
@@ -1,24 +1,39 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.responses import HTMLResponse, Response
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Any, Dict, Optional, List
 import html
+from urllib.parse import urlencode
 
-from backend.db import init_db
+from backend.db import close_db, run_db
+from backend.migrations import init_db, current_version
 from backend.crud_sqlite import (
-    insert_message,
     list_kus,
     get_ku,
     get_or_create_default_project,
     finalize_due_batches,
+    restore_ku_revision,
+    KUConflictError,
 )
-from backend.scheduler import BatchScheduler
+from backend.ingest import IngestBuffer
+from backend.llm_client import aclose_llm_client, get_governor
+from backend.llm_cache import llm_cache
+from backend.worker import build_scheduler
+from backend.retention import RetentionService, retention_stats, load_archived_messages
+from backend.batch_policy import get_chat_policy, set_chat_policy, default_policy
+from backend.search import search_kus, search_messages
+from backend.jobs import job_stats, retry_failed_jobs
+from backend.ku_budget import load_ku_history, history_size
+from backend.ku_revisions import list_revisions, reconstruct
 from config import settings
 
 app = FastAPI()
 
-# для тестов 5 секунд, прод-режима можно 60
-scheduler = BatchScheduler(tick_seconds=5)
+# планировщик и воркеры финализации работают в этом процессе только в роли all;
+# в роли api их запускает отдельный процесс (run.py --role worker)
+job_pool, scheduler = build_scheduler()
+retention = RetentionService(interval_seconds=settings.retention_interval_seconds)
+ingest_buffer = IngestBuffer(flush_ms=settings.ingest_flush_ms, max_batch=settings.ingest_max_batch)
 
 
 class TelegramMessageIn(BaseModel):
@@ -30,54 +45,198 @@ class TelegramMessageIn(BaseModel):
     sent_at: Optional[int] = None
 
 
+class ChatPolicyIn(BaseModel):
+    # null — значение по умолчанию из settings
+    max_messages: Optional[int] = Field(default=None, gt=0)
+    max_chars: Optional[int] = Field(default=None, gt=0)
+    idle_seconds: Optional[int] = Field(default=None, gt=0)
+    max_window_seconds: Optional[int] = Field(default=None, gt=0)
+
+
 @app.on_event("startup")
 async def on_startup():
-    init_db()
-    get_or_create_default_project()
-    await scheduler.start()
-    print("✅ DB initialized, scheduler started")
+    await run_db(init_db)
+    await run_db(get_or_create_default_project)
+    await ingest_buffer.start()
+    if settings.process_role == "all":
+        await job_pool.start()
+        await scheduler.start()
+        await retention.start()
+        print("✅ DB initialized, scheduler started")
+    else:
+        print(f"✅ DB initialized (role={settings.process_role}, scheduler runs in worker)")
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    await retention.stop()
     await scheduler.stop()
+    await job_pool.stop()
+    await ingest_buffer.stop()
+    await aclose_llm_client()
+    close_db()
     print(" Scheduler stopped")
 
 
+def _db_health() -> Dict[str, Any]:
+    return {"schema_version": current_version(), "jobs": job_stats()}
+
+
+def _kus_page(**kwargs) -> Dict[str, Any]:
+    project = get_or_create_default_project()
+    return list_kus(project_id=project["id"], **kwargs)
+
+
 @app.get("/health")
-def health():
+async def health():
+    db = await run_db(_db_health)
     return {
         "ok": True,
         "db_path": settings.db_path,
-        "batch_window_seconds": settings.batch_window_seconds,
-        "tick_seconds": 5,
+        "schema_version": db["schema_version"],
+        "process_role": settings.process_role,
+        "batch_policy": default_policy(),
+        "scheduler": scheduler.stats(),
         "llm_provider": settings.llm_provider,
         "llm_model": settings.llm_model,
+        "llm_governor": get_governor().stats(),
+        "jobs": db["jobs"],
     }
 
 
 @app.post("/telegram/message")
-def telegram_message(m: TelegramMessageIn):
-    started_new = insert_message(
-        chat_id=m.chat_id,
-        text=m.text,
-        user_id=m.user_id,
-        user_name=m.user_name,
-        message_id=m.message_id,
-        sent_at=m.sent_at,
-    )
+async def telegram_message(m: TelegramMessageIn):
+    started_new = await ingest_buffer.submit(m.model_dump())
     return {"ok": True, "started_new_batch": started_new}
 
 
+@app.post("/telegram/messages:bulk")
+async def telegram_messages_bulk(items: List[TelegramMessageIn]):
+    flags = await ingest_buffer.submit_many([m.model_dump() for m in items])
+    return {"ok": True, "count": len(flags), "started_new_batch": flags}
+
+
+@app.get("/chats/{chat_id}/policy")
+async def get_policy(chat_id: str):
+    return {"chat_id": chat_id, **(await run_db(get_chat_policy, chat_id))}
+
+
+@app.put("/chats/{chat_id}/policy")
+async def put_policy(chat_id: str, p: ChatPolicyIn):
+    # только переданные поля; явный null возвращает значение по умолчанию
+    policy = await run_db(set_chat_policy, chat_id, **p.model_dump(exclude_unset=True))
+    scheduler.resync()
+    return {"chat_id": chat_id, **policy}
+
+
 @app.get("/kus")
-def get_kus_json():
-    project = get_or_create_default_project()
-    return list_kus(project_id=project["id"])
+async def get_kus_json(response: Response, limit: int = 50, cursor: Optional[str] = None,
+                       status: Optional[str] = None, type: Optional[str] = None, include_content: bool = True):
+    # прежний формат — список KU с content_ai, но одна страница; курсор следующей — в X-Next-Cursor / Link
+    try:
+        page = await run_db(_kus_page, limit=limit, cursor=cursor,
+                            status=status, ku_type=type, include_content=include_content)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page["next_cursor"]:
+        response.headers["X-Next-Cursor"] = page["next_cursor"]
+        query = {"limit": limit, "cursor": page["next_cursor"], "status": status, "type": type}
+        if not include_content:
+            query["include_content"] = "false"
+        query = urlencode({k: v for k, v in query.items() if v is not None})
+        response.headers["Link"] = f'</kus?{query}>; rel="next"'
+    return page["items"]
+
+
+@app.get("/kus/page")
+async def get_kus_page(limit: int = 50, cursor: Optional[str] = None, status: Optional[str] = None,
+                       type: Optional[str] = None, include_content: bool = False):
+    try:
+        return await run_db(_kus_page, limit=limit, cursor=cursor,
+                            status=status, ku_type=type, include_content=include_content)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/search")
+async def search(q: str, scope: str = "kus", limit: int = 20, offset: int = 0,
+                 status: Optional[str] = None, chat_id: Optional[str] = None):
+    # полнотекстовый поиск: scope=kus — по KU, scope=messages — по сообщениям чатов
+    if scope == "messages":
+        return await run_db(search_messages, q, limit=limit, offset=offset, chat_id=chat_id)
+    if scope != "kus":
+        raise HTTPException(status_code=400, detail="scope must be 'kus' or 'messages'")
+    project = await run_db(get_or_create_default_project)
+    return await run_db(search_kus, project["id"], q, limit=limit, offset=offset, status=status)
 
 
 @app.post("/debug/finalize_now")
-def finalize_now():
-    return finalize_due_batches(settings.batch_window_seconds)
+async def finalize_now():
+    return await finalize_due_batches()
+
+
+@app.get("/debug/jobs")
+async def jobs_stats():
+    return await run_db(job_stats)
+
+
+@app.post("/debug/jobs/retry_failed")
+async def jobs_retry_failed():
+    n = await run_db(retry_failed_jobs)
+    job_pool.notify()
+    return {"ok": True, "requeued": n}
+
+
+@app.get("/debug/retention")
+async def retention_info():
+    return await run_db(retention_stats)
+
+
+@app.get("/archive/{job_id}")
+async def archived_messages(job_id: int):
+    messages = await run_db(load_archived_messages, job_id)
+    if messages is None:
+        raise HTTPException(status_code=404, detail="archive not found")
+    return {"job_id": job_id, "messages": messages}
+
+
+@app.get("/ku/{ku_id}/history")
+async def ku_history(ku_id: str, limit: int = 50, offset: int = 0):
+    # вытесненные бюджетом части content_ai (в LLM не отправляются)
+    if await run_db(get_ku, ku_id) is None:
+        raise HTTPException(status_code=404, detail="KU not found")
+    return await run_db(load_ku_history, ku_id, limit=max(1, min(limit, 500)), offset=max(0, offset))
+
+
+@app.get("/ku/{ku_id}/revisions")
+async def ku_revisions(ku_id: str, limit: int = 50, offset: int = 0):
+    if await run_db(get_ku, ku_id) is None:
+        raise HTTPException(status_code=404, detail="KU not found")
+    return await run_db(list_revisions, ku_id, limit=max(1, min(limit, 500)), offset=max(0, offset))
+
+
+@app.get("/ku/{ku_id}/revisions/{version}")
+async def ku_revision(ku_id: str, version: int):
+    rev = await run_db(reconstruct, ku_id, version)
+    if rev is None:
+        raise HTTPException(status_code=404, detail="revision not found")
+    return rev
+
+
+@app.post("/ku/{ku_id}/revisions/{version}/restore")
+async def ku_revision_restore(ku_id: str, version: int):
+    try:
+        ku = await run_db(restore_ku_revision, ku_id, version)
+    except KUConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if ku is None:
+        raise HTTPException(status_code=404, detail="revision not found")
+    return {"ok": True, "ku_id": ku_id, "restored_from": version, "version": ku["version"]}
+
+
+@app.get("/debug/llm_cache")
+def llm_cache_stats():
+    return llm_cache.stats()
 
 
 @app.get("/favicon.ico")
@@ -125,9 +284,12 @@ def _layout(title: str, body: str) -> str:
 
 
 @app.get("/", response_class=HTMLResponse)
-def home():
-    project = get_or_create_default_project()
-    kus = list_kus(project_id=project["id"])
+async def home(cursor: Optional[str] = None):
+    try:
+        page = await run_db(_kus_page, limit=80, cursor=cursor)
+    except ValueError:
+        page = await run_db(_kus_page, limit=80)
+    kus = page["items"]
 
     if not kus:
         body = """
@@ -139,12 +301,12 @@ def home():
         return _layout("Knowledge Units", body)
 
     cards = []
-    for ku in kus[:80]:
+    for ku in kus:
         cid = ku["id"]
         title = html.escape(ku["title"] or "(без названия)")
         ku_type = html.escape(ku["type"])
         status = html.escape(ku["status"])
-        summary = html.escape((ku.get("content_ai") or {}).get("summary", "")[:260])
+        summary = html.escape((ku.get("summary") or "")[:260])
 
         cards.append(f"""
         <div class="card">
@@ -161,16 +323,24 @@ def home():
         </div>
         """)
 
+    if page["next_cursor"]:
+        cards.append(f'<div class="muted"><a href="/?cursor={page["next_cursor"]}">Дальше →</a></div>')
+
     return _layout("Knowledge Units", "\n".join(cards))
 
 
 @app.get("/ku/{ku_id}", response_class=HTMLResponse)
-def ku_page(ku_id: str):
-    ku = get_ku(ku_id)
+async def ku_page(ku_id: str):
+    ku = await run_db(get_ku, ku_id)
     if not ku:
         return _layout("KU не найден", f'<div class="card">KU <code>{html.escape(ku_id)}</code> не найден.</div>')
 
     c = ku.get("content_ai") or {}
+    rolled = await run_db(history_size, ku_id)
+    history_link = ""
+    if rolled:
+        history_link = (f'<div class="muted"><a href="/ku/{html.escape(ku_id)}/history">'
+                        f'история: {rolled} свёрнутых записей</a></div>')
     title = ku.get("title", "KU")
     ku_type = ku.get("type", "")
     status = ku.get("status", "")
@@ -219,6 +389,7 @@ def ku_page(ku_id: str):
     <div class="card">
       <h2>Notes</h2>
       {render_list(c.get("notes", []))}
+      {history_link}
     </div>
     """
 
@@ -0,0 +1,374 @@
+import sqlite3
+import time
+from typing import Callable, List, Tuple
+
+from backend.db import get_conn, transaction
+from config import settings
+
+
+# -------------------------
+# Migrations
+# -------------------------
+# Каждая миграция — функция, получающая соединение внутри открытой транзакции.
+# Порядок и номера менять нельзя: новые миграции только дописываются в конец.
+
+def _m001_base_tables(conn: sqlite3.Connection) -> None:
+    # IF NOT EXISTS — чтобы старые talkset.db (до schema_version) проходили без ошибок
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS projects (
+      id TEXT PRIMARY KEY,
+      name TEXT NOT NULL,
+      short_context TEXT NOT NULL,
+      project_summary TEXT NOT NULL DEFAULT '',
+      status TEXT NOT NULL DEFAULT 'active'
+    );
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS kus (
+      id TEXT PRIMARY KEY,
+      project_id TEXT,
+      type TEXT NOT NULL,
+      title TEXT NOT NULL,
+      status TEXT NOT NULL,
+      content_ai_json TEXT NOT NULL,
+      content_human TEXT NOT NULL DEFAULT '',
+      created_at INTEGER NOT NULL,
+      last_activity_at INTEGER NOT NULL
+    );
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS messages (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      chat_id TEXT NOT NULL,
+      user_id TEXT,
+      user_name TEXT,
+      message_id TEXT,
+      sent_at INTEGER,
+      text TEXT NOT NULL,
+      created_at INTEGER NOT NULL
+    );
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS open_batches (
+      chat_id TEXT PRIMARY KEY,
+      started_at INTEGER NOT NULL
+    );
+    """)
+
+
+def _m002_hot_path_indexes(conn: sqlite3.Connection) -> None:
+    # finalize: WHERE chat_id = ? AND created_at >= ? ORDER BY created_at
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages(chat_id, created_at)")
+    # _active_kus_brief: WHERE project_id = ? AND status = 'Active' ORDER BY last_activity_at
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kus_project_status_activity ON kus(project_id, status, last_activity_at)")
+    # list_kus: WHERE project_id = ? ORDER BY last_activity_at
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kus_project_activity ON kus(project_id, last_activity_at)")
+    conn.execute("ANALYZE")
+
+
+def _m003_llm_cache(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS llm_cache (
+      key TEXT PRIMARY KEY,
+      value_json TEXT NOT NULL,
+      created_at INTEGER NOT NULL,
+      last_hit_at INTEGER NOT NULL
+    );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_hit ON llm_cache(last_hit_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at)")
+
+
+def _m004_batch_jobs(conn: sqlite3.Connection) -> None:
+    # durable-очередь финализации: одна строка на закрытое окно чата
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS batch_jobs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      chat_id TEXT NOT NULL,
+      window_start INTEGER NOT NULL,
+      window_end INTEGER NOT NULL,
+      after_message_id INTEGER NOT NULL,
+      max_message_id INTEGER NOT NULL,
+      state TEXT NOT NULL,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      lease_owner TEXT,
+      lease_expires_at INTEGER,
+      available_at INTEGER NOT NULL,
+      last_error TEXT,
+      result_json TEXT,
+      created_at INTEGER NOT NULL,
+      updated_at INTEGER NOT NULL
+    );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_state_available ON batch_jobs(state, available_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_state_lease ON batch_jobs(state, lease_expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_chat ON batch_jobs(chat_id, max_message_id)")
+
+
+def _m005_adaptive_batches(conn: sqlite3.Connection) -> None:
+    # счётчики открытого окна — чтобы закрывать его по объёму и по паузе без чтения messages
+    conn.execute("ALTER TABLE open_batches ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE open_batches ADD COLUMN char_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE open_batches ADD COLUMN last_message_at INTEGER")
+    conn.execute("""
+    UPDATE open_batches SET
+      message_count = (SELECT COUNT(*) FROM messages m
+                       WHERE m.chat_id = open_batches.chat_id AND m.created_at >= open_batches.started_at),
+      char_count = (SELECT COALESCE(SUM(LENGTH(m.text)), 0) FROM messages m
+                    WHERE m.chat_id = open_batches.chat_id AND m.created_at >= open_batches.started_at),
+      last_message_at = COALESCE((SELECT MAX(m.created_at) FROM messages m
+                                  WHERE m.chat_id = open_batches.chat_id), started_at)
+    """)
+
+    # политики закрытия окна по чатам; NULL — значение по умолчанию из settings
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS chat_policies (
+      chat_id TEXT PRIMARY KEY,
+      max_messages INTEGER,
+      max_chars INTEGER,
+      idle_seconds INTEGER,
+      max_window_seconds INTEGER,
+      updated_at INTEGER NOT NULL
+    );
+    """)
+
+
+def _m006_leases(conn: sqlite3.Connection) -> None:
+    # именованные lease'ы между процессами (лидер планировщика и т.п.)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS leases (
+      name TEXT PRIMARY KEY,
+      owner TEXT NOT NULL,
+      expires_at REAL NOT NULL,
+      acquired_at REAL NOT NULL
+    );
+    """)
+
+
+def _m007_ku_version(conn: sqlite3.Connection) -> None:
+    # оптимистичная блокировка: unit of work пишет KU только если version не изменилась
+    conn.execute("ALTER TABLE kus ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+
+def _m008_ku_listing(conn: sqlite3.Connection) -> None:
+    # summary рядом со строкой — список KU не декодирует content_ai_json
+    conn.execute("ALTER TABLE kus ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+    conn.execute("UPDATE kus SET summary = COALESCE(json_extract(content_ai_json, '$.summary'), '')")
+
+    # keyset-пагинация: ORDER BY last_activity_at DESC, id DESC (+ фильтры status / type)
+    conn.execute("DROP INDEX IF EXISTS idx_kus_project_activity")
+    conn.execute("DROP INDEX IF EXISTS idx_kus_project_status_activity")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kus_project_activity_id ON kus(project_id, last_activity_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kus_project_status_activity_id ON kus(project_id, status, last_activity_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kus_project_type_activity_id ON kus(project_id, type, last_activity_at, id)")
+    conn.execute("ANALYZE")
+
+
+def _m009_full_text_search(conn: sqlite3.Connection) -> None:
+    # KU: своя FTS-таблица (поля достаются из content_ai_json), rowid = kus.rowid
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS kus_fts USING fts5(
+      title, summary, decisions, notes,
+      tokenize = 'unicode61 remove_diacritics 2'
+    );
+    """)
+    ku_fts_row = """
+      SELECT {src}.rowid, {src}.title,
+             COALESCE(json_extract({src}.content_ai_json, '$.summary'), ''),
+             COALESCE((SELECT group_concat(value, char(10)) FROM json_each({src}.content_ai_json, '$.decisions')), ''),
+             COALESCE((SELECT group_concat(value, char(10)) FROM json_each({src}.content_ai_json, '$.notes')), '')
+    """
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS kus_fts_ai AFTER INSERT ON kus BEGIN
+      INSERT INTO kus_fts (rowid, title, summary, decisions, notes) {ku_fts_row.format(src="new")};
+    END;
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS kus_fts_au AFTER UPDATE OF title, content_ai_json ON kus BEGIN
+      DELETE FROM kus_fts WHERE rowid = old.rowid;
+      INSERT INTO kus_fts (rowid, title, summary, decisions, notes) {ku_fts_row.format(src="new")};
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS kus_fts_ad AFTER DELETE ON kus BEGIN
+      DELETE FROM kus_fts WHERE rowid = old.rowid;
+    END;
+    """)
+    conn.execute(f"""
+    INSERT INTO kus_fts (rowid, title, summary, decisions, notes)
+    {ku_fts_row.format(src="kus")} FROM kus
+    """)
+
+    # сообщения: external content — текст не дублируется, индекс ссылается на messages.id
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+      text, content = 'messages', content_rowid = 'id',
+      tokenize = 'unicode61 remove_diacritics 2'
+    );
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+      INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+      INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+      INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+      INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END;
+    """)
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def _m010_message_retention(conn: sqlite3.Connection) -> None:
+    # каким job'ом сообщение обработано (NULL — ещё не обработано)
+    conn.execute("ALTER TABLE messages ADD COLUMN processed_job_id INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_processed_job ON messages(processed_job_id)")
+    conn.execute("""
+    UPDATE messages SET processed_job_id = (
+      SELECT j.id FROM batch_jobs j
+      WHERE j.state = 'done' AND j.chat_id = messages.chat_id
+        AND messages.id > j.after_message_id AND messages.id <= j.max_message_id
+    )
+    """)
+
+    conn.execute("ALTER TABLE batch_jobs ADD COLUMN archived_at INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_archive ON batch_jobs(state, archived_at, updated_at)")
+
+    # холодное хранилище: сообщения одного job'а — один zlib-сжатый JSON-блоб
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS message_archive (
+      job_id INTEGER PRIMARY KEY,
+      chat_id TEXT NOT NULL,
+      window_start INTEGER NOT NULL,
+      window_end INTEGER NOT NULL,
+      first_message_id INTEGER,
+      last_message_id INTEGER,
+      message_count INTEGER NOT NULL,
+      codec TEXT NOT NULL,
+      payload BLOB NOT NULL,
+      archived_at INTEGER NOT NULL
+    );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_message_archive_chat ON message_archive(chat_id, window_start)")
+
+
+def _m011_ku_history(conn: sqlite3.Connection) -> None:
+    # вытесненные бюджетом части content_ai: одна zlib-сжатая пачка на коммит KU
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ku_history (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      ku_id TEXT NOT NULL,
+      rolled_at INTEGER NOT NULL,
+      item_count INTEGER NOT NULL,
+      codec TEXT NOT NULL,
+      payload BLOB NOT NULL
+    );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ku_history_ku ON ku_history(ku_id, id)")
+
+
+def _m012_ku_revisions(conn: sqlite3.Connection) -> None:
+    # история content_ai: дельта к предыдущей версии или периодический полный снимок (zlib JSON)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ku_revisions (
+      ku_id TEXT NOT NULL,
+      version INTEGER NOT NULL,
+      kind TEXT NOT NULL,
+      job_id INTEGER,
+      topics_json TEXT NOT NULL DEFAULT '[]',
+      codec TEXT NOT NULL,
+      payload BLOB NOT NULL,
+      created_at INTEGER NOT NULL,
+      PRIMARY KEY (ku_id, version)
+    ) WITHOUT ROWID;
+    """)
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "base tables", _m001_base_tables),
+    (2, "hot-path indexes on messages and kus", _m002_hot_path_indexes),
+    (3, "llm response cache", _m003_llm_cache),
+    (4, "batch finalization job queue", _m004_batch_jobs),
+    (5, "adaptive batch closing: window counters and chat policies", _m005_adaptive_batches),
+    (6, "inter-process leases", _m006_leases),
+    (7, "optimistic version column on kus", _m007_ku_version),
+    (8, "stored KU summary and keyset pagination indexes", _m008_ku_listing),
+    (9, "FTS5 search over KUs and messages", _m009_full_text_search),
+    (10, "message retention: processed marks and compressed archive", _m010_message_retention),
+    (11, "rolled-up KU content history", _m011_ku_history),
+    (12, "KU revisions: deltas with periodic snapshots", _m012_ku_revisions),
+]
+
+
+def _ensure_version_table(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+      version INTEGER PRIMARY KEY,
+      description TEXT NOT NULL,
+      applied_at INTEGER NOT NULL
+    );
+    """)
+
+
+def current_version() -> int:
+    row = get_conn().execute("SELECT MAX(version) AS v FROM schema_version").fetchone()
+    return row["v"] or 0
+
+
+def migrate() -> List[int]:
+    """
+    Применяет все недостающие миграции по порядку, каждую в своей транзакции.
+    Версия перепроверяется под write-lock'ом, поэтому несколько процессов,
+    стартующих одновременно, не применят одну миграцию дважды.
+    Возвращает список применённых версий.
+    """
+    applied: List[int] = []
+    for version, description, fn in MIGRATIONS:
+        with transaction() as conn:
+            _ensure_version_table(conn)
+            row = conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone()
+            if row:
+                continue
+            fn(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, int(time.time()))
+            )
+        applied.append(version)
+    return applied
+
+
+def _init_incremental_vacuum() -> None:
+    """
+    На новой, пустой базе сразу включает auto_vacuum=INCREMENTAL (VACUUM пустого
+    файла мгновенный). Существующую базу на старте не трогаем: полный VACUUM
+    держал бы write-lock и старт процесса — её переключают отдельным шагом
+    обслуживания (run.py --convert-auto-vacuum).
+    """
+    conn = get_conn()
+    if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is not None:
+        return
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    except sqlite3.OperationalError as e:
+        print(" DB: auto_vacuum=INCREMENTAL postponed:", e)
+
+
+def init_db() -> None:
+    if settings.db_incremental_vacuum:
+        _init_incremental_vacuum()
+    applied = migrate()
+    if applied:
+        print(f" DB migrated to v{applied[-1]} (applied: {applied})")
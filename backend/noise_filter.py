@@ -0,0 +1,109 @@
+import hashlib
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+
+# Локальный пре-фильтр очевидного шума: то, что select_relevant всё равно выкинул бы,
+# но за что мы платили бы токенами. Правила намеренно консервативные —
+# строка удаляется, только если она ЦЕЛИКОМ состоит из шума.
+
+_ACK_WORDS = [
+    # приветствия / прощания
+    "привет", "приветик", "прив", "здравствуйте", "здрасте", "здарова", "хай", "hi", "hello",
+    "доброе утро", "добрый день", "добрый вечер", "доброй ночи", "всем привет",
+    "пока", "до встречи", "спокойной ночи",
+    # реакции и односложные ответы
+    "ок", "окей", "оки", "ok", "okay", "kk", "ага", "угу", "ну", "пон", "понял", "поняла",
+    "ясно", "ясненько", "понятно", "спс", "спасибо", "благодарю", "thx", "thanks", "пж", "пжл",
+    "лол", "lol", "кек", "ахах", "хаха", "хех", "жиза", "норм", "класс", "супер", "круто",
+    "+", "++", "+1",
+]
+
+_ACK_ALT = "|".join(re.escape(w) for w in sorted(_ACK_WORDS, key=len, reverse=True))
+_ACK_RE = re.compile(rf"^(?:{_ACK_ALT})(?:[\s,]+(?:{_ACK_ALT}))*$", re.IGNORECASE)
+
+# смех и растянутые междометия: "ахахахах", "хахаха", "ааааа", "ммм"
+_LAUGH_RE = re.compile(r"^(?:[ах]{4,}|(?:he){2,}|(?:ha){2,}|([^\W\d_])\1{2,})$", re.IGNORECASE)
+
+# тестовый мусор: "qwe", "asdf", "тест", "test", "йцук" и их повторы; из цифр — только ровно "123"
+# ("1234", "123123" могут быть суммой или кодом)
+_JUNK_RE = re.compile(
+    r"^(?:(?:qwe(?:rty)?|asd(?:f)?|zxc|йцук(?:ен)?|фыва|ячс|test|тест)+|123)$",
+    re.IGNORECASE,
+)
+
+_PUNCT_SPACE_RE = re.compile(r"[\W_]+", re.UNICODE)
+# только буквы: "1000" и "10" — разные числа
+_REPEAT_RE = re.compile(r"([^\W\d_])\1{2,}")
+
+
+def _is_emoji_or_symbols_only(text: str) -> bool:
+    """Нет ни одной буквы/цифры — только эмодзи, символы, пунктуация, пробелы."""
+    for ch in text:
+        cat = unicodedata.category(ch)
+        if cat[0] in ("L", "N"):
+            return False
+    return True
+
+
+def _normalize(text: str) -> str:
+    t = text.lower().replace("ё", "е")
+    t = _PUNCT_SPACE_RE.sub(" ", t).strip()
+    # "ооочень" == "очень"
+    return _REPEAT_RE.sub(r"\1", t)
+
+
+def _line_hash(text: str) -> str:
+    return hashlib.blake2b(_normalize(text).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def noise_reason(text: str) -> str:
+    """Возвращает причину, по которой строка — шум, или "" если строку надо оставить."""
+    t = (text or "").strip()
+    if not t:
+        return "empty"
+    if _is_emoji_or_symbols_only(t):
+        return "emoji"
+
+    core = _PUNCT_SPACE_RE.sub(" ", t).strip()
+    if not core:
+        return "emoji"
+    if _ACK_RE.match(core):
+        return "ack"
+    compact = core.replace(" ", "")
+    if _LAUGH_RE.match(compact):
+        return "ack"
+    if _JUNK_RE.match(compact):
+        return "junk"
+    return ""
+
+
+def filter_noise(texts: List[str],
+                 speakers: Optional[List[str]] = None) -> Tuple[List[int], Dict[str, int]]:
+    """
+    Прогоняет тексты сообщений батча через правила и дедупликацию
+    (точные и «почти» повторы после нормализации регистра/пунктуации/растяжек).
+    speakers — авторы строк: повтором считается только повтор того же автора
+    (одинаковые ответы/голоса разных людей остаются).
+    Возвращает индексы строк, которые надо оставить, и счётчики удалённого по причинам.
+    """
+    keep: List[int] = []
+    dropped: Dict[str, int] = {}
+    seen = set()
+
+    for i, text in enumerate(texts):
+        reason = noise_reason(text)
+        if not reason:
+            h = (speakers[i] if speakers else "", _line_hash(text))
+            if h in seen:
+                reason = "duplicate"
+            else:
+                seen.add(h)
+
+        if reason:
+            dropped[reason] = dropped.get(reason, 0) + 1
+        else:
+            keep.append(i)
+
+    return keep, dropped
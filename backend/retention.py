@@ -0,0 +1,210 @@
+import asyncio
+import json
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+from backend.db import get_conn, transaction, run_db
+from backend.leases import acquire_lease, release_lease
+from config import settings
+
+
+ARCHIVE_CODEC = "zlib-json"
+
+_MESSAGE_COLUMNS = ("id", "chat_id", "user_id", "user_name", "message_id", "sent_at", "text", "created_at")
+
+
+# -------------------------
+# Архив: сообщения обработанного job'а → один сжатый блоб
+# -------------------------
+def _pack(rows: List[Any]) -> bytes:
+    data = [[r[c] for c in _MESSAGE_COLUMNS] for r in rows]
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(raw, 6)
+
+
+def _unpack(payload: bytes) -> List[Dict[str, Any]]:
+    data = json.loads(zlib.decompress(payload).decode("utf-8"))
+    return [dict(zip(_MESSAGE_COLUMNS, row)) for row in data]
+
+
+def archive_job(job: Dict[str, Any]) -> int:
+    """
+    Переносит сообщения одного done-job'а в message_archive и удаляет их из messages
+    (FTS-индекс сообщений чистят триггеры). Одна транзакция на job.
+    Возвращает число заархивированных сообщений.
+    """
+    now = int(time.time())
+    with transaction() as conn:
+        rows = conn.execute(f"""
+          SELECT {", ".join(_MESSAGE_COLUMNS)} FROM messages
+          WHERE processed_job_id = ?
+          ORDER BY id
+        """, (job["id"],)).fetchall()
+
+        if rows:
+            conn.execute("""
+              INSERT OR REPLACE INTO message_archive (job_id, chat_id, window_start, window_end,
+                                                      first_message_id, last_message_id, message_count,
+                                                      codec, payload, archived_at)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (job["id"], job["chat_id"], job["window_start"], job["window_end"],
+                  rows[0]["id"], rows[-1]["id"], len(rows), ARCHIVE_CODEC, _pack(rows), now))
+            conn.execute("DELETE FROM messages WHERE processed_job_id = ?", (job["id"],))
+
+        conn.execute("UPDATE batch_jobs SET archived_at = ? WHERE id = ?", (now, job["id"]))
+    return len(rows)
+
+
+def archive_processed_messages(older_than_seconds: int, max_jobs: int = 200) -> Dict[str, int]:
+    """Архивирует сообщения job'ов, завершённых больше older_than_seconds назад."""
+    cutoff = int(time.time()) - older_than_seconds
+    jobs = get_conn().execute("""
+      SELECT id, chat_id, window_start, window_end FROM batch_jobs
+      WHERE state = 'done' AND archived_at IS NULL AND updated_at < ?
+      ORDER BY id
+      LIMIT ?
+    """, (cutoff, max_jobs)).fetchall()
+
+    archived = 0
+    for job in jobs:
+        archived += archive_job(dict(job))
+    return {"jobs": len(jobs), "messages": archived}
+
+
+def load_archived_messages(job_id: int) -> Optional[List[Dict[str, Any]]]:
+    row = get_conn().execute(
+        "SELECT codec, payload FROM message_archive WHERE job_id = ?", (job_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    if row["codec"] != ARCHIVE_CODEC:
+        raise ValueError(f"unknown archive codec: {row['codec']}")
+    return _unpack(row["payload"])
+
+
+# -------------------------
+# Incremental vacuum
+# -------------------------
+def ensure_incremental_vacuum() -> bool:
+    """
+    Переводит существующую базу в auto_vacuum=INCREMENTAL — разовый полный VACUUM.
+    Держит write-lock всё время VACUUM'а (на большой базе — минуты), поэтому это
+    отдельный шаг обслуживания при остановленных api/worker: run.py --convert-auto-vacuum.
+    False — не вышло (база занята).
+    """
+    conn = get_conn()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return True
+    print(" DB: switching to auto_vacuum=INCREMENTAL (one-time VACUUM)...")
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    except sqlite3.OperationalError as e:
+        print(" DB: auto_vacuum switch postponed:", e)
+        return False
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def incremental_vacuum(max_pages: int) -> int:
+    """Возвращает ОС до max_pages свободных страниц; без auto_vacuum=INCREMENTAL — ничего не делает."""
+    conn = get_conn()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if not free_before:
+        return 0
+    # через execute() sqlite3 делает один шаг = одна страница; executescript прогоняет pragma целиком
+    conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+    return free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def retention_stats() -> Dict[str, Any]:
+    conn = get_conn()
+    archive = conn.execute("""
+      SELECT COUNT(*) AS jobs, COALESCE(SUM(message_count), 0) AS messages,
+             COALESCE(SUM(LENGTH(payload)), 0) AS bytes
+      FROM message_archive
+    """).fetchone()
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        "hot_messages": conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+        "unprocessed_messages": conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE processed_job_id IS NULL"
+        ).fetchone()[0],
+        "archived_jobs": archive["jobs"],
+        "archived_messages": archive["messages"],
+        "archive_bytes": archive["bytes"],
+        "db_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+        "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(
+            conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        ),
+    }
+
+
+# -------------------------
+# Фоновая задача
+# -------------------------
+class RetentionService:
+    """
+    Раз в interval_seconds: архивирует старые обработанные сообщения и понемногу
+    возвращает свободные страницы. Между процессами работу делает только
+    держатель lease'а LEASE (остальные пропускают тик).
+    """
+
+    LEASE = "retention"
+
+    def __init__(self, interval_seconds: float = 600.0):
+        self._interval_seconds = interval_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._stop_event: Optional[asyncio.Event] = None
+
+    async def start(self) -> None:
+        if self._task is not None or not settings.retention_enabled:
+            return
+        self._stop_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stop_event.set()
+        await self._task
+        self._task = None
+        await run_db(release_lease, self.LEASE)
+
+    async def run_once(self) -> Dict[str, Any]:
+        archived = {"jobs": 0, "messages": 0}
+        # пачками, чтобы не держать write-lock долго и давать место приёму сообщений
+        while True:
+            step = await run_db(archive_processed_messages, settings.message_retention_seconds,
+                                settings.retention_batch_jobs)
+            archived["jobs"] += step["jobs"]
+            archived["messages"] += step["messages"]
+            if step["jobs"] < settings.retention_batch_jobs or self._stop_event.is_set():
+                break
+
+        freed = 0
+        while not self._stop_event.is_set():
+            pages = await run_db(incremental_vacuum, settings.vacuum_pages_per_step)
+            freed += pages
+            if pages < settings.vacuum_pages_per_step:
+                break
+        return {"archived": archived, "freed_pages": freed}
+
+    async def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                if await run_db(acquire_lease, self.LEASE, self._interval_seconds * 2):
+                    result = await self.run_once()
+                    if result["archived"]["jobs"] or result["freed_pages"]:
+                        print(" retention:", result)
+            except Exception as e:
+                print("Retention error:", e)
+
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self._interval_seconds)
+            except asyncio.TimeoutError:
+                pass
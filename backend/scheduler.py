@@ -1,37 +1,261 @@
 import asyncio
-from config import settings
-from backend.crud_sqlite import finalize_due_batches
+import heapq
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
+from backend.crud_sqlite import (
+    get_or_create_default_project,
+    run_job,
+    list_open_batches,
+    open_batches_fingerprint,
+    close_batch_if_due,
+    on_batch_updated,
+    remove_batch_listener,
+)
+from backend.db import run_db
+from backend.jobs import claim_job
+from backend.leases import acquire_lease, release_lease
 
-class BatchScheduler:
-    def __init__(self, tick_seconds: int = 60):
-        self._tick_seconds = tick_seconds
-        self._task = None
+
+class JobWorkerPool:
+    """
+    Воркеры очереди batch_jobs: каждый берёт job через claim_job (lease в SQLite),
+    обрабатывает и берёт следующий. Когда очередь пуста — спят до notify()
+    или до poll_seconds (job мог поставить другой процесс / подошёл retry).
+    """
+
+    def __init__(self, workers: int, poll_seconds: float = 5.0):
+        self._workers = max(1, workers)
+        self._poll_seconds = poll_seconds
+        self._tasks: List[asyncio.Task] = []
+        self._stop_event: Optional[asyncio.Event] = None
+        self._wake_event: Optional[asyncio.Event] = None
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        # события создаём внутри работающего loop'а
         self._stop_event = asyncio.Event()
+        self._wake_event = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self._workers)]
+
+    async def stop(self) -> None:
+        if not self._tasks:
+            return
+        self._stop_event.set()
+        self._wake_event.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        if self._wake_event is not None:
+            self._wake_event.set()
+
+    async def _worker(self, n: int) -> None:
+        project_id: Optional[str] = None
+        while not self._stop_event.is_set():
+            # ошибка итерации (например, БД) не должна убивать воркер — пул не сжимается молча
+            try:
+                if project_id is None:
+                    project_id = (await run_db(get_or_create_default_project))["id"]
+                job = await run_db(claim_job)
+                if job is not None:
+                    result = await run_job(project_id, job)
+                    print(" batch finalized:", result)
+                    continue
+            except Exception as e:
+                print(f"Job worker {n} error:", e)
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=self._poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._wake_event.clear()
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout=self._poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+
+class BatchScheduler:
+    """
+    Закрывает окна батчей точно по дедлайну политики чата (batch_policy):
+    бюджет сообщений/символов, пауза idle_seconds или жёсткий max_window_seconds.
+    Дедлайны лежат в min-heap: insert_messages сообщает о каждом изменении окна
+    (on_batch_updated), планировщик спит ровно до ближайшего дедлайна,
+    перепроверяет окно по БД, закрывает его (job в batch_jobs) и будит пул воркеров.
+    При старте heap собирается из open_batches; раз в resync_seconds — заново.
+    Окна, открытые или дополненные другими процессами (API при раздельных ролях),
+    лидер замечает за watch_seconds: сверяет дешёвый отпечаток open_batches
+    и при изменении пересобирает heap.
+
+    Если процессов несколько (uvicorn --workers, несколько run.py), окна закрывает
+    только держатель lease'а LEADER_LEASE; остальные держат heap тёплым и раз в
+    lease_seconds/3 пробуют перехватить лидерство. Сам close_batch атомарен
+    (условный DELETE), так что даже при смене лидера окно не закроется дважды.
+    """
+
+    LEADER_LEASE = "batch_scheduler"
+
+    def __init__(self, resync_seconds: float = 60.0, lease_seconds: float = 30.0,
+                 pool: Optional[JobWorkerPool] = None, watch_seconds: float = 0.0):
+        self._resync_seconds = resync_seconds
+        self._watch_seconds = watch_seconds
+        self._fingerprint: Optional[Tuple[int, ...]] = None
+        self._lease_seconds = lease_seconds
+        self._pool = pool
+        self.is_leader = False
+        self._resync_requested = False
+        self._heap: List[Tuple[int, str, int]] = []
+        # актуальный дедлайн по чату; записи heap, которые с ним не совпадают, устарели
+        self._deadlines: Dict[str, Tuple[int, int]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._wake_event: Optional[asyncio.Event] = None
+        self.closed = 0
 
     async def start(self) -> None:
         if self._task is not None:
             return
-        self._stop_event.clear()
+        # события создаём внутри работающего loop'а — планировщик можно перезапускать
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._wake_event = asyncio.Event()
+        self._resync_requested = False
+        await self._resync()
+        on_batch_updated(self._on_batch_updated)
         self._task = asyncio.create_task(self._run())
 
     async def stop(self) -> None:
         if self._task is None:
             return
+        remove_batch_listener(self._on_batch_updated)
         self._stop_event.set()
+        self._wake_event.set()
         await self._task
         self._task = None
+        if self.is_leader:
+            await run_db(release_lease, self.LEADER_LEASE)
+            self.is_leader = False
+
+    def stats(self) -> Dict[str, Any]:
+        next_deadline = min((d for _, d in self._deadlines.values()), default=None)
+        return {
+            "leader": self.is_leader,
+            "open_batches": len(self._deadlines),
+            "next_deadline_in": round(next_deadline - time.time(), 1) if next_deadline is not None else None,
+            "closed": self.closed,
+        }
+
+    def _on_batch_updated(self, chat_id: str, started_at: int, deadline: int) -> None:
+        # вызывается из потока insert_messages — в heap кладём уже в своём loop'е
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._push, chat_id, started_at, deadline)
+        except RuntimeError:
+            # loop уже закрыт — окно подхватит resync при следующем старте
+            pass
+
+    def _push(self, chat_id: str, started_at: int, deadline: int) -> None:
+        if self._deadlines.get(chat_id) == (started_at, deadline):
+            return
+        self._deadlines[chat_id] = (started_at, deadline)
+        heapq.heappush(self._heap, (deadline, chat_id, started_at))
+        if self._heap[0][0] == deadline and self._wake_event is not None:
+            self._wake_event.set()
+
+    def resync(self) -> None:
+        """Пересобрать дедлайны из БД (например, после смены политики чата)."""
+        if self._loop is None or self._task is None:
+            return
+        self._loop.call_soon_threadsafe(self._request_resync)
+
+    def _request_resync(self) -> None:
+        self._resync_requested = True
+        self._wake_event.set()
+
+    async def _resync(self) -> None:
+        # отпечаток — до чтения: изменение между ними вызовет лишний, но не пропущенный resync
+        self._fingerprint = await run_db(open_batches_fingerprint)
+        batches = await run_db(list_open_batches)
+        # окна, о которых сообщили, пока шёл запрос, сохраняем — лишние отсеются при pop
+        deadlines = dict(self._deadlines)
+        deadlines.update({b["chat_id"]: (b["started_at"], b["deadline"]) for b in batches})
+        self._deadlines = deadlines
+        self._heap = [(d, chat_id, started_at) for chat_id, (started_at, d) in deadlines.items()]
+        heapq.heapify(self._heap)
+
+    async def _close_due(self) -> int:
+        now = time.time()
+        closed = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, chat_id, started_at = heapq.heappop(self._heap)
+            if self._deadlines.get(chat_id) != (started_at, deadline):
+                continue
+            del self._deadlines[chat_id]
+
+            job_id, batch = await run_db(close_batch_if_due, chat_id)
+            if job_id is not None:
+                closed += 1
+            elif batch is not None:
+                # окно продлилось (новые сообщения из другого процесса) — ждём новый дедлайн
+                self._push(chat_id, batch["started_at"], batch["deadline"])
+        self.closed += closed
+        return closed
+
+    async def _check_leadership(self) -> bool:
+        """Продлевает/перехватывает lease лидера; True — если только что им стали."""
+        was_leader = self.is_leader
+        try:
+            self.is_leader = await run_db(acquire_lease, self.LEADER_LEASE, self._lease_seconds)
+        except Exception as e:
+            print("Scheduler lease error:", e)
+            self.is_leader = False
+        if self.is_leader != was_leader:
+            print(" batch scheduler:", "leader" if self.is_leader else "follower")
+        return self.is_leader and not was_leader
 
     async def _run(self) -> None:
+        renew_every = self._lease_seconds / 3
+        next_renew = 0.0
+        next_resync = time.monotonic() + self._resync_seconds
+        next_watch = time.monotonic() + self._watch_seconds
         while not self._stop_event.is_set():
             try:
-                results = finalize_due_batches(settings.batch_window_seconds)
-                for r in results:
-                    print(" batch finalized:", r)
+                if time.monotonic() >= next_renew:
+                    if await self._check_leadership():
+                        # пока были ведомыми, окна могли открыть/закрыть другие процессы
+                        next_resync = 0.0
+                    next_renew = time.monotonic() + renew_every
+
+                if self.is_leader:
+                    if self._watch_seconds > 0 and time.monotonic() >= next_watch:
+                        if await run_db(open_batches_fingerprint) != self._fingerprint:
+                            self._resync_requested = True
+                        next_watch = time.monotonic() + self._watch_seconds
+                    if time.monotonic() >= next_resync or self._resync_requested:
+                        self._resync_requested = False
+                        await self._resync()
+                        next_resync = time.monotonic() + self._resync_seconds
+                    if await self._close_due() and self._pool is not None:
+                        self._pool.notify()
             except Exception as e:
                 print("Scheduler error:", e)
 
+            timeout = next_renew - time.monotonic()
+            if self.is_leader:
+                timeout = min(timeout, next_resync - time.monotonic())
+                if self._watch_seconds > 0:
+                    timeout = min(timeout, next_watch - time.monotonic())
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - time.time())
+
+            self._wake_event.clear()
             try:
-                await asyncio.wait_for(self._stop_event.wait(), timeout=self._tick_seconds)
+                await asyncio.wait_for(self._wake_event.wait(), timeout=max(0.0, timeout))
             except asyncio.TimeoutError:
                 pass
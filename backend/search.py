@@ -0,0 +1,81 @@
+import re
+from typing import Any, Dict, List, Optional
+
+from backend.db import get_conn
+
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+# веса bm25 по колонкам kus_fts: title, summary, decisions, notes
+_KU_WEIGHTS = (5.0, 2.0, 3.0, 1.0)
+
+
+def fts_query(q: str, max_terms: int = 16) -> str:
+    """
+    Пользовательский ввод → безопасный FTS5-запрос: только слова, каждое в кавычках
+    и с префиксным поиском ("созвон"* найдёт и «созвоне»), между словами — AND.
+    Операторы и спецсимволы FTS5 из ввода не проходят. Пустая строка — искать нечего.
+    """
+    terms = _TERM_RE.findall(q or "")[:max_terms]
+    return " ".join(f'"{t}"*' for t in terms)
+
+
+def _page(rows: List[Any], limit: int, offset: int) -> Dict[str, Any]:
+    items = [dict(r) for r in rows[:limit]]
+    return {"items": items, "next_offset": offset + limit if len(rows) > limit else None}
+
+
+def search_kus(project_id: str, q: str, limit: int = 20, offset: int = 0,
+               status: Optional[str] = None) -> Dict[str, Any]:
+    """Поиск KU по title/summary/decisions/notes, по релевантности (bm25), со сниппетом."""
+    match = fts_query(q)
+    limit = max(1, min(int(limit), 100))
+    offset = max(0, int(offset))
+    if not match:
+        return {"items": [], "next_offset": None}
+
+    where = ["kus_fts MATCH ?", "k.project_id = ?"]
+    params: List[Any] = [match, project_id]
+    if status:
+        where.append("k.status = ?")
+        params.append(status)
+
+    rows = get_conn().execute(f"""
+      SELECT k.id, k.title, k.type, k.status, k.last_activity_at,
+             snippet(kus_fts, -1, '[', ']', '…', 16) AS snippet,
+             bm25(kus_fts, {", ".join(map(str, _KU_WEIGHTS))}) AS rank
+      FROM kus_fts
+      JOIN kus k ON k.rowid = kus_fts.rowid
+      WHERE {" AND ".join(where)}
+      ORDER BY rank
+      LIMIT ? OFFSET ?
+    """, (*params, limit + 1, offset)).fetchall()
+    return _page(rows, limit, offset)
+
+
+def search_messages(q: str, limit: int = 20, offset: int = 0,
+                    chat_id: Optional[str] = None) -> Dict[str, Any]:
+    """Поиск по сырым сообщениям чатов (messages.text), по релевантности, со сниппетом."""
+    match = fts_query(q)
+    limit = max(1, min(int(limit), 100))
+    offset = max(0, int(offset))
+    if not match:
+        return {"items": [], "next_offset": None}
+
+    where = ["messages_fts MATCH ?"]
+    params: List[Any] = [match]
+    if chat_id:
+        where.append("m.chat_id = ?")
+        params.append(chat_id)
+
+    rows = get_conn().execute(f"""
+      SELECT m.id, m.chat_id, m.user_name, m.created_at,
+             snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet,
+             bm25(messages_fts) AS rank
+      FROM messages_fts
+      JOIN messages m ON m.id = messages_fts.rowid
+      WHERE {" AND ".join(where)}
+      ORDER BY rank
+      LIMIT ? OFFSET ?
+    """, (*params, limit + 1, offset)).fetchall()
+    return _page(rows, limit, offset)
@@ -0,0 +1,59 @@
+import asyncio
+import signal
+from typing import Tuple
+
+from backend.db import close_db, run_db
+from backend.migrations import init_db
+from backend.crud_sqlite import get_or_create_default_project
+from backend.llm_client import aclose_llm_client
+from backend.scheduler import BatchScheduler, JobWorkerPool
+from backend.retention import RetentionService
+from config import settings
+
+
+def build_scheduler() -> Tuple[JobWorkerPool, BatchScheduler]:
+    """Пул воркеров очереди batch_jobs и планировщик закрытия окон, который его будит."""
+    pool = JobWorkerPool(workers=settings.finalize_concurrency, poll_seconds=settings.job_poll_seconds)
+    scheduler = BatchScheduler(
+        resync_seconds=settings.scheduler_resync_seconds,
+        lease_seconds=settings.scheduler_lease_seconds,
+        pool=pool,
+        watch_seconds=settings.scheduler_watch_seconds,
+    )
+    return pool, scheduler
+
+
+async def run_worker() -> None:
+    """
+    Процесс-воркер (роль worker): закрытие окон, финализация батчей → KU и ретенция сообщений.
+    HTTP не поднимает; сообщения пишет API-процесс, окна подхватываются
+    из open_batches (resync) и job'ы — из batch_jobs.
+    """
+    await run_db(init_db)
+    await run_db(get_or_create_default_project)
+
+    pool, scheduler = build_scheduler()
+    retention = RetentionService(interval_seconds=settings.retention_interval_seconds)
+    await pool.start()
+    await scheduler.start()
+    await retention.start()
+    print("⚙️ Worker started")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows / не главный поток — останавливаемся по KeyboardInterrupt
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        await retention.stop()
+        await scheduler.stop()
+        await pool.stop()
+        await aclose_llm_client()
+        close_db()
+        print(" Worker stopped")
@@ -1,10 +1,14 @@
-import httpx
+from typing import Optional
+
 from aiogram import Bot, Dispatcher, F, types
 from config import settings
+from bot.forwarder import MessageForwarder, build_forwarder
 
 bot = Bot(token=settings.bot_token)
 dp = Dispatcher()
 
+forwarder: Optional[MessageForwarder] = None
+
 
 @dp.message(F.text)
 async def on_message(msg: types.Message):
@@ -20,13 +24,16 @@ async def on_message(msg: types.Message):
         "sent_at": int(msg.date.timestamp()) if msg.date else None,
     }
 
-    async with httpx.AsyncClient(timeout=20) as client:
-        try:
-            await client.post(f"{settings.backend_url}/telegram/message", json=payload)
-        except Exception as e:
-            print(f"Ошибка при отправке на backend: {e}")
+    await forwarder.put(payload)
 
 
 async def start_bot():
+    global forwarder
+    forwarder = build_forwarder()
+    await forwarder.start()
+
     print("🤖 Telegram bot started")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await forwarder.stop()
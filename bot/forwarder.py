@@ -0,0 +1,130 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from config import settings
+
+
+class HttpTransport:
+    """Отправка пачек на POST /telegram/messages:bulk через одно keep-alive соединение."""
+
+    def __init__(self, backend_url: str, timeout: float = 20):
+        self._url = f"{backend_url.rstrip('/')}/telegram/messages:bulk"
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4, keepalive_expiry=60),
+        )
+
+    async def send(self, items: List[Dict[str, Any]]) -> None:
+        resp = await self._client.post(self._url, json=items)
+        resp.raise_for_status()
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+class EmbeddedTransport:
+    """
+    Режим «всё в одном процессе» (run.py): пачки отдаются прямо в IngestBuffer
+    backend'а, без JSON/HTTP/повторной валидации. Для раздельного деплоя — HttpTransport.
+    """
+
+    def __init__(self):
+        # импорт здесь, чтобы бот в HTTP-режиме не тянул backend
+        from backend.main import ingest_buffer
+        self._buffer = ingest_buffer
+
+    async def send(self, items: List[Dict[str, Any]]) -> None:
+        await self._buffer.submit_threadsafe(items)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class MessageForwarder:
+    """
+    Очередь с коалесцированием: сообщения из хендлеров складываются в очередь,
+    а фоновая задача отправляет их пачками до max_batch штук, ожидая не дольше
+    max_delay_ms после первого сообщения пачки.
+    Очередь ограничена — при перегрузке хендлер ждёт на put() (backpressure).
+    """
+
+    def __init__(self, transport, max_batch: int = 100, max_delay_ms: int = 200,
+                 queue_size: int = 10000, retries: int = 3):
+        self._transport = transport
+        self._max_batch = max_batch
+        self._max_delay = max_delay_ms / 1000
+        self._retries = retries
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Досылает всё, что осталось в очереди, и закрывает транспорт."""
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        await self._transport.aclose()
+
+    async def put(self, item: Dict[str, Any]) -> None:
+        await self._queue.put(item)
+
+    async def _collect(self, first: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], bool]:
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._max_delay
+        while len(batch) < self._max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _send(self, batch: List[Dict[str, Any]]) -> None:
+        delay = 0.5
+        for attempt in range(self._retries + 1):
+            try:
+                await self._transport.send(batch)
+                return
+            except Exception as e:
+                if attempt == self._retries:
+                    print(f"Ошибка при отправке на backend ({len(batch)} сообщений потеряно): {e}")
+                    return
+                print(f"Ошибка при отправке на backend, повтор через {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _run(self) -> None:
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch, stopping = await self._collect(first)
+            await self._send(batch)
+            if stopping:
+                return
+
+
+def build_forwarder() -> MessageForwarder:
+    if (settings.ingest_transport or "").lower() == "embedded":
+        transport = EmbeddedTransport()
+    else:
+        transport = HttpTransport(settings.backend_url)
+
+    return MessageForwarder(
+        transport,
+        max_batch=settings.bot_forward_max_batch,
+        max_delay_ms=settings.bot_forward_max_delay_ms,
+        queue_size=settings.bot_forward_queue_size,
+    )
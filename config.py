@@ -18,11 +18,98 @@ class Settings(BaseSettings):
     openai_api_key: Optional[str] = None
 
     backend_url: str = "http://127.0.0.1:8000"
+    process_role: str = "all"  # api | worker | bot | all (run.py --role)
+    api_workers: int = 1  # процессов uvicorn в роли api
     db_path: str = "talkset.db"
-    batch_window_seconds: int = 6 * 60 * 60
+    batch_window_seconds: int = 6 * 60 * 60  # жёсткий предел окна от первого сообщения
+
+    # Адаптивное закрытие окна (дефолты; по чатам — таблица chat_policies, 0 — правило выключено)
+    batch_max_messages: int = 200
+    batch_max_chars: int = 12000
+    batch_idle_seconds: int = 30 * 60
+
+    # SQLite: постоянные соединения + WAL
+    db_synchronous: str = "NORMAL"  # OFF | NORMAL | FULL
+    db_cache_size_kb: int = 64 * 1024
+    db_mmap_size: int = 256 * 1024 * 1024
+    db_busy_timeout_ms: int = 5000
+    db_cached_statements: int = 256
+    db_executor_threads: int = 4  # пул потоков для async-доступа к БД (run_db)
+    db_incremental_vacuum: bool = True  # auto_vacuum=INCREMENTAL для новой базы (старую — run.py --convert-auto-vacuum)
+
+    # group commit входящих сообщений
+    ingest_flush_ms: int = 50
+    ingest_max_batch: int = 500
+
+    # бот → backend: пачки сообщений по одному keep-alive соединению
+    bot_forward_max_batch: int = 100
+    bot_forward_max_delay_ms: int = 200
+    bot_forward_queue_size: int = 10000
+    # http — бот шлёт на backend_url; embedded — бот и backend в одном run.py,
+    # сообщения идут в IngestBuffer напрямую через in-memory очередь
+    ingest_transport: str = "http"  # http | embedded
 
     llm_provider: str = "proxyapi"  # proxyapi | openai
     llm_model: str = "gpt-3.5-turbo"
+    llm_max_concurrency: int = 8  # одновременных запросов к LLM на процесс
+
+    # governor: лимиты (по умолчанию — по провайдеру), ретраи, circuit breaker
+    llm_requests_per_minute: Optional[int] = None
+    llm_tokens_per_minute: Optional[int] = None
+    llm_expected_output_tokens: int = 800  # добавка к оценке токенов запроса
+    llm_max_retries: int = 4
+    llm_retry_base_delay: float = 1.0
+    llm_retry_max_delay: float = 30.0
+    llm_breaker_failures: int = 5
+    llm_breaker_reset_seconds: float = 30.0
+    llm_breaker_max_park_seconds: float = 120.0
+
+    # кэш ответов LLM: LRU в памяти + таблица llm_cache
+    llm_cache_enabled: bool = True
+    llm_cache_memory_entries: int = 512
+    llm_cache_ttl_seconds: int = 7 * 24 * 60 * 60
+    llm_cache_max_rows: int = 20000
+    llm_cache_nondeterministic: bool = False  # кэшировать и при temperature > 0
+
+    finalize_concurrency: int = 4  # воркеров очереди батчей (чатов параллельно)
+    job_lease_seconds: int = 300
+    job_max_attempts: int = 5
+    job_retry_base_seconds: int = 30
+    job_poll_seconds: float = 5.0  # как часто пустой воркер перепроверяет очередь
+    scheduler_resync_seconds: float = 60.0  # пересборка дедлайнов из open_batches (окна других процессов)
+    scheduler_watch_seconds: float = 1.5  # опрос отпечатка open_batches: окна из API-процесса (0 — выкл.)
+    scheduler_lease_seconds: float = 30.0  # lease лидера планировщика между процессами
+
+    # Ретенция сообщений: обработанные окна старше срока → сжатый архив, потом incremental_vacuum
+    retention_enabled: bool = True
+    message_retention_seconds: int = 7 * 24 * 60 * 60
+    retention_interval_seconds: float = 600.0
+    retention_batch_jobs: int = 200
+    vacuum_pages_per_step: int = 2000
+
+    # Бюджеты content_ai KU: вытесненное (старое) уходит в сжатую ku_history и в LLM не отправляется
+    ku_budget_enabled: bool = True
+    ku_summary_max_chars: int = 1000
+    ku_item_max_chars: int = 400  # один пункт списка / одна заметка
+    ku_list_max_items: int = 15  # decisions / open_questions / next_steps
+    ku_notes_max_items: int = 10
+    ku_notes_max_chars: int = 2000
+
+    # Ревизии KU: каждая запись content_ai — дельта в ku_revisions, каждая N-я — полный снимок
+    ku_revisions_enabled: bool = True
+    ku_revision_snapshot_every: int = 20
+    noise_filter_enabled: bool = True  # локальный пре-фильтр шума перед select_relevant
+    select_chunk_tokens: int = 3000  # бюджет одного чанка select_relevant (оценка)
+
+    # локальный векторный индекс KU для маршрутизации
+    ku_index_enabled: bool = True
+    ku_index_top_k: int = 15  # сколько кандидатов отдаём в decide_ku_action
+    ku_index_auto_update_threshold: float = 0.6  # выше — update_ku без LLM
+    ku_index_rebuild_seconds: int = 600
+
+    # two_step — decide_ku_action + update_ku_content; single_call — один вызов route_and_update
+    pipeline_mode: str = "two_step"  # two_step | single_call
+    single_call_content_candidates: int = 3  # скольким кандидатам передаём текущий контент
 
 
 settings = Settings()
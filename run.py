@@ -1,23 +1,96 @@
+import argparse
+import os
+import sys
 import threading
 import asyncio
 import uvicorn
 
-from backend.main import app
-from bot.bot import start_bot
+
+ROLES = ("api", "worker", "bot", "all")
 
 
 def run_backend():
+    from backend.main import app
     uvicorn.run(app, host="127.0.0.1", port=8000)
 
 
+def run_api(workers: int):
+    # по строке импорта — чтобы uvicorn мог поднять несколько процессов
+    uvicorn.run("backend.main:app", host="127.0.0.1", port=8000, workers=workers)
+
+
+def run_worker():
+    from backend.worker import run_worker as worker_main
+    try:
+        asyncio.run(worker_main())
+    except KeyboardInterrupt:
+        pass
+
+
 def run_bot():
+    from bot.bot import start_bot
     asyncio.run(start_bot())
 
 
+def run_convert_auto_vacuum() -> int:
+    from backend.db import close_db
+    from backend.migrations import init_db
+    from backend.retention import ensure_incremental_vacuum
+    init_db()
+    ok = ensure_incremental_vacuum()
+    close_db()
+    print("✅ auto_vacuum=INCREMENTAL" if ok else "❌ auto_vacuum не переключён (база занята?)")
+    return 0 if ok else 1
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="talkset")
+    parser.add_argument(
+        "--role", choices=ROLES, default=None,
+        help="api — HTTP (приём и чтение), worker — финализация батчей, bot — Telegram, all — всё в одном процессе "
+             "(по умолчанию — PROCESS_ROLE из окружения/.env)",
+    )
+    parser.add_argument(
+        "--convert-auto-vacuum", action="store_true",
+        help="разово перевести существующую базу в auto_vacuum=INCREMENTAL (полный VACUUM) и выйти; "
+             "запускать при остановленных api/worker",
+    )
+    args = parser.parse_args()
+    if args.role:
+        # settings читаются из окружения при импорте — выставляем роль до него (и для процессов uvicorn)
+        os.environ["PROCESS_ROLE"] = args.role
+    from config import settings
+
+    role = args.role or settings.process_role
+    if role not in ROLES:
+        parser.error(f"PROCESS_ROLE={role!r}: ожидается одна из {', '.join(ROLES)}")
+    if role == "bot" and settings.ingest_transport == "embedded":
+        parser.error("--role bot несовместима с ingest_transport=embedded: в процессе бота нет backend'а, "
+                     "который примет сообщения (нужен ingest_transport=http или --role all)")
+    args.role = role
+    return args
+
+
 if __name__ == "__main__":
-    print("🚀 Starting backend...")
-    backend_thread = threading.Thread(target=run_backend, daemon=True)
-    backend_thread.start()
+    args = parse_args()
+    if args.convert_auto_vacuum:
+        sys.exit(run_convert_auto_vacuum())
+    role = args.role
+    from config import settings
+
+    if role == "api":
+        print("🚀 Starting backend (api)...")
+        run_api(settings.api_workers)
+    elif role == "worker":
+        print("⚙️ Starting worker...")
+        run_worker()
+    elif role == "bot":
+        print("🤖 Starting Telegram bot...")
+        run_bot()
+    else:
+        print("🚀 Starting backend...")
+        backend_thread = threading.Thread(target=run_backend, daemon=True)
+        backend_thread.start()
 
-    print("🤖 Starting Telegram bot...")
-    run_bot()
+        print("🤖 Starting Telegram bot...")
+        run_bot()